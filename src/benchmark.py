@@ -0,0 +1,489 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Dexter benchmarks
+
+Usage:
+  benchmark tokenizer [--lines=N] [--repeat=N] [--seed=N]
+  benchmark corpus <path> [--files=N] [--size=KB] [--vocabulary=N] [--zipf=S] [--seed=N]
+  benchmark commands [<path>] [--files=N] [--size=KB] [--vocabulary=N] [--zipf=S] [--seed=N] [--format=FORMAT] [--jobs=N] [--lookups=N] [--output=FILE]
+  benchmark startup [<path>] [--files=N] [--size=KB] [--vocabulary=N] [--zipf=S] [--seed=N] [--repeat=N] [--output=FILE]
+  benchmark -h | --help
+
+Options:
+  tokenizer     Compares the tokenizer with the original per-character scan
+  corpus <path> Generates a synthetic corpus of text files in the path
+  commands [<path>] Times the index, read, find and list command paths over
+                a synthetic corpus, generated in the path if one is given,
+                otherwise in a temporary directory which is then removed
+  startup [<path>] Times 'find' and 'list' commands started as new processes,
+                as shell hooks and editors run them, over an index of a
+                synthetic corpus, generated as for 'commands'
+  --lines=N     Number of lines of text to tokenize [default: 20000]
+  --repeat=N    Number of times to repeat each timing, keeping the best [default: 5]
+  --seed=N      Seed for the random text generator [default: 1]
+  --files=N     Number of files in the corpus [default: 200]
+  --size=KB     Approximate size of each file in the corpus, in kilobytes [default: 32]
+  --vocabulary=N  Number of distinct words in the corpus [default: 20000]
+  --zipf=S      Exponent of the Zipf distribution of the words [default: 1.1]
+  --format=FORMAT  Index file format to benchmark [default: text]
+  --jobs=N      Number of processes to build the index with [default: 1]
+  --lookups=N   Number of words to search for in the find benchmark [default: 100]
+  --output=FILE Also write the results to the file, as JSON
+  -h --help     Show this screen
+"""
+
+# Standard library imports
+import os
+import sys
+import random
+import timeit
+import time
+import bisect
+import json
+import shutil
+import tempfile
+import multiprocessing
+import subprocess
+
+# Third party imports
+from docopt import docopt
+
+# Optional imports: the resource module is not available on Windows, in
+# which case peak memory usage is not reported
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Application specific imports
+import dexter
+from dexter import Tokenizer
+
+# Number of corpus files written to each sub-directory
+FILES_PER_FOLDER = 100
+
+# Folder holding the dexter module, which the start-up benchmark runs from
+SOURCE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+def legacy_scan_line(line):
+    """
+    The original per-character implementation of Dexter.scan_line(), kept
+    as the baseline for the tokenizer benchmark. Unlike the tokenizer it
+    does not skip short words, so they are filtered out here as well.
+    """
+    words = []
+    word = ""
+    alpha = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+    for char in line:
+        if char in alpha:
+            word += char
+        else:
+            if word.strip() != "":
+                words.append(word.strip().lower())
+            word = ""
+
+    return [word for word in words if len(word) > 2]
+
+def make_lines(count, seed):
+    """
+    Returns a list of random lines of text, made up of words of mixed case
+    and length separated by spaces and punctuation.
+    """
+    generator = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    separators = [" ", " ", " ", ", ", ". ", " - ", "(", ")", "_", "0"]
+    lines = []
+    for i in xrange(count):
+        parts = []
+        for j in xrange(generator.randint(4, 16)):
+            length = generator.randint(1, 12)
+            parts.append("".join(generator.choice(letters) for k in xrange(length)))
+            parts.append(generator.choice(separators))
+        lines.append("".join(parts) + "\n")
+    return lines
+
+def best_time(function, repeat):
+    """
+    Returns the fastest of several timings of the supplied function.
+    """
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def benchmark_tokenizer(lines, repeat):
+    """
+    Times the original per-character scan against the tokenizer, one line
+    at a time and over the whole text as a single buffer, and prints the
+    results.
+    """
+    tokenizer = Tokenizer()
+    text = "".join(lines)
+
+    # Check that the implementations agree before timing them
+    expected = [word for line in lines for word in legacy_scan_line(line)]
+    assert [word for line in lines for word in tokenizer.words(line)] == expected
+    assert [word for number, words in tokenizer.lines(text) for word in words] == expected
+
+    timings = [
+        ("per-character scan_line", best_time(lambda: [legacy_scan_line(line) for line in lines], repeat)),
+        ("tokenizer, per line", best_time(lambda: [tokenizer.words(line) for line in lines], repeat)),
+        ("tokenizer, whole buffer", best_time(lambda: tokenizer.lines(text), repeat)),
+    ]
+
+    megabytes = len(text) / 1048576.0
+    print "Tokenizing %d lines (%.2f MB), %d words" % (len(lines), megabytes, len(expected))
+    baseline = timings[0][1]
+    for name, seconds in timings:
+        print "{:25} {:8.4f}s {:8.2f} MB/s {:6.1f}x".format(name, seconds, megabytes / seconds, baseline / seconds)
+
+# --------------------------------------------------------------------------
+# Synthetic corpus
+# --------------------------------------------------------------------------
+
+class ZipfSampler():
+
+    """
+    Picks words at random from a vocabulary, so that the frequency of each
+    word is inversely proportional to a power of its rank (Zipf's law), as
+    it is in natural text.
+    """
+
+    def __init__(self, words, exponent, generator):
+        self.words = words
+        self.generator = generator
+        self.cumulative = []
+        total = 0.0
+        for rank in xrange(1, len(words) + 1):
+            total += 1.0 / (rank ** exponent)
+            self.cumulative.append(total)
+        self.total = total
+
+    def sample(self):
+        """
+        Returns a word picked at random.
+        """
+        return self.words[bisect.bisect(self.cumulative, self.generator.random() * self.total)]
+
+def make_vocabulary(count, generator):
+    """
+    Returns a list of distinct random words, of between 3 and 12 letters,
+    in a random order which becomes their order of frequency.
+    """
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < count:
+        length = generator.randint(3, 12)
+        words.add("".join(generator.choice(letters) for i in xrange(length)))
+    words = sorted(words)
+    generator.shuffle(words)
+    return words
+
+def make_corpus(path, files, size, vocabulary, zipf, seed):
+    """
+    Writes a reproducible synthetic corpus of text files into the path, in
+    sub-directories of FILES_PER_FOLDER files each. Each file is roughly
+    size bytes long, made up of lines of words picked from a vocabulary of
+    the specified number of words, following a Zipf distribution with the
+    specified exponent. Returns a dictionary describing the corpus.
+    """
+    generator = random.Random(seed)
+    words = make_vocabulary(vocabulary, generator)
+    sampler = ZipfSampler(words, zipf, generator)
+    total_bytes = 0
+    total_words = 0
+    for number in xrange(files):
+        folder = os.path.join(path, "d%03d" % (number // FILES_PER_FOLDER))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        lines = []
+        length = 0
+        while length < size:
+            line_words = [sampler.sample() for i in xrange(generator.randint(6, 14))]
+            # Capitalise the first word, as in a sentence
+            line = " ".join(line_words).capitalize() + ".\n"
+            lines.append(line)
+            length += len(line)
+            total_words += len(line_words)
+        with open(os.path.join(folder, "f%05d.txt" % number), "w") as f:
+            f.write("".join(lines))
+        total_bytes += length
+    return {
+        "files": files,
+        "bytes": total_bytes,
+        "words": total_words,
+        "vocabulary": vocabulary,
+        "zipf": zipf,
+        "seed": seed,
+    }
+
+# --------------------------------------------------------------------------
+# Command benchmarks
+# --------------------------------------------------------------------------
+
+def peak_memory():
+    """
+    Returns the peak resident memory of the current process, in kilobytes,
+    or None if this is not available.
+    """
+    if not resource:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Reported in bytes rather than kilobytes
+        peak = peak // 1024
+    return peak
+
+def run_phase(phase, argv, words):
+    """
+    Runs one phase of the command benchmark. This is called in a separate
+    process for each phase, so that the peak memory reported is for that
+    phase alone. The output of the commands is discarded.
+
+    argv is the command-line to set Dexter up with, and words is the list
+    of words to search for in the 'find' phase.
+    """
+    sys.stdout = open(os.devnull, "w")
+    api = dexter.Dexter()
+    api.setup(docopt(dexter.__doc__, argv=argv))
+
+    # The CPU time includes that of any worker processes started by the phase
+    start_wall = time.time()
+    start_cpu = sum(os.times()[:4])
+    if phase == "index":
+        api.make_index()
+    elif phase == "read":
+        api.read_index()
+    elif phase == "find":
+        for word in words:
+            api.word = word
+            api.find_word()
+    elif phase == "list":
+        api.list_words()
+    result = {
+        "wall": time.time() - start_wall,
+        "cpu": sum(os.times()[:4]) - start_cpu,
+        "peak_memory_kb": peak_memory(),
+    }
+    if phase == "read":
+        result["postings"] = api.dictionary.location_count()
+        result["terms"] = len(api.dictionary)
+    return result
+
+def send_phase_result(connection, phase, argv, words):
+    """
+    Runs one phase of the command benchmark and sends the results back to
+    the parent process over the supplied connection.
+    """
+    connection.send(run_phase(phase, argv, words))
+    connection.close()
+
+def run_phase_process(phase, argv, words=()):
+    """
+    Runs one phase of the command benchmark in a new process, returning
+    its results. A plain Process is used rather than a Pool, as the index
+    phase may need to start worker processes of its own.
+    """
+    (receiver, sender) = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=send_phase_result, args=(sender, phase, argv, words))
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    except EOFError:
+        raise RuntimeError("The %s phase of the benchmark failed" % phase)
+    finally:
+        process.join()
+
+def benchmark_commands(path, corpus_settings, format, jobs, lookups):
+    """
+    Generates a corpus in the path, then times building the index, reading
+    it, searching it for a number of words and listing it, returning a
+    dictionary of the results.
+    """
+    work = tempfile.mkdtemp(prefix="dexter-benchmark-")
+    try:
+        # An empty ignore file, so that the results do not depend on the
+        # user's own settings
+        ignore_file = os.path.join(work, "ignore")
+        open(ignore_file, "w").close()
+
+        start = time.time()
+        corpus = make_corpus(path, **corpus_settings)
+        corpus["generate_seconds"] = time.time() - start
+
+        options = ["--ignore=%s" % ignore_file]
+        phases = {}
+        phases["index"] = run_phase_process("index",
+            ["-r", "index", path, "-f", "--format=%s" % format, "--jobs=%d" % jobs] + options)
+        phases["read"] = run_phase_process("read", ["list", "in", path] + options)
+
+        # Search for a mix of words, as frequent as they are in the corpus,
+        # along with some missing ones
+        generator = random.Random(corpus_settings["seed"])
+        sampler = ZipfSampler(make_vocabulary(corpus_settings["vocabulary"], generator), corpus_settings["zipf"], generator)
+        words = [sampler.sample() if i % 10 else "missing%s" % chr(97 + i % 26) for i in xrange(lookups)]
+        phases["find"] = run_phase_process("find", ["find", "-", "in", path] + options, words)
+        phases["list"] = run_phase_process("list", ["list", "in", path] + options)
+    finally:
+        shutil.rmtree(work)
+
+    if format == "text":
+        index_size = os.path.getsize(os.path.join(path, "dexter.index"))
+    else:
+        index_size = os.path.getsize(os.path.join(path, "dexter.bindex"))
+    postings = phases["read"]["postings"]
+    megabytes = corpus["bytes"] / 1048576.0
+    phases["index"]["files_per_second"] = corpus["files"] / phases["index"]["wall"]
+    phases["index"]["mb_per_second"] = megabytes / phases["index"]["wall"]
+    for phase in ("index", "read", "list"):
+        phases[phase]["postings_per_second"] = postings / phases[phase]["wall"]
+    phases["find"]["lookups_per_second"] = lookups / phases["find"]["wall"]
+
+    return {
+        "benchmark": "commands",
+        "python": sys.version.split()[0],
+        "format": format,
+        "jobs": jobs,
+        "lookups": lookups,
+        "corpus": corpus,
+        "index_bytes": index_size,
+        "postings": postings,
+        "terms": phases["read"]["terms"],
+        "phases": phases,
+    }
+
+def print_command_results(results):
+    """
+    Prints the results of the command benchmark as a table.
+    """
+    corpus = results["corpus"]
+    print "Corpus: %d files, %.2f MB, %d words, vocabulary %d, zipf %.2f" % (
+        corpus["files"], corpus["bytes"] / 1048576.0, corpus["words"], corpus["vocabulary"], corpus["zipf"])
+    print "Index: %s format, %.2f MB, %d terms, %d postings" % (
+        results["format"], results["index_bytes"] / 1048576.0, results["terms"], results["postings"])
+    print "{:8} {:>9} {:>9} {:>10} {:>14}  {}".format("phase", "wall (s)", "cpu (s)", "peak (MB)", "postings/s", "other")
+    for phase in ("index", "read", "find", "list"):
+        result = results["phases"][phase]
+        peak = "-" if result["peak_memory_kb"] is None else "%.1f" % (result["peak_memory_kb"] / 1024.0)
+        postings = "-" if "postings_per_second" not in result else "%.0f" % result["postings_per_second"]
+        if phase == "index":
+            other = "%.1f files/s, %.2f MB/s" % (result["files_per_second"], result["mb_per_second"])
+        elif phase == "find":
+            other = "%.1f lookups/s" % result["lookups_per_second"]
+        else:
+            other = ""
+        print "{:8} {:9.3f} {:9.3f} {:>10} {:>14}  {}".format(phase, result["wall"], result["cpu"], peak, postings, other)
+
+# --------------------------------------------------------------------------
+# Start-up benchmark
+# --------------------------------------------------------------------------
+
+def time_process(argv, repeat):
+    """
+    Returns the fastest of several timings of running the supplied command
+    line as a new process, from the folder holding the dexter module, with
+    its output discarded.
+    """
+    timings = []
+    with open(os.devnull, "w") as devnull:
+        for i in xrange(repeat):
+            start = time.time()
+            subprocess.check_call(argv, stdout=devnull, cwd=SOURCE_PATH)
+            timings.append(time.time() - start)
+    return min(timings)
+
+def benchmark_startup(path, corpus_settings, repeat):
+    """
+    Generates a corpus in the path and indexes it, then times complete
+    'find' and 'list' commands, each run as a new Python process, returning
+    a dictionary of the results. Starting Python and importing the dexter
+    module are timed as well, for comparison, and 'find' is timed both when
+    dexter.py is run as a script and when it is imported (as dexter.sh
+    does), which lets Python reuse its compiled form.
+    """
+    work = tempfile.mkdtemp(prefix="dexter-benchmark-")
+    try:
+        # An empty ignore file, so that the results do not depend on the
+        # user's own settings
+        ignore_file = os.path.join(work, "ignore")
+        open(ignore_file, "w").close()
+        option = "--ignore=%s" % ignore_file
+
+        corpus = make_corpus(path, **corpus_settings)
+        python = sys.executable
+        script = [python, "dexter.py"]
+        imported = [python, "-c", "import dexter; dexter.main()"]
+        subprocess.check_call(script + ["-r", "index", path, option], cwd=SOURCE_PATH)
+
+        # The most frequent word in the corpus
+        word = make_vocabulary(corpus_settings["vocabulary"], random.Random(corpus_settings["seed"]))[0]
+        commands = [
+            ("python", [python, "-c", "pass"]),
+            ("import", [python, "-c", "import dexter"]),
+            ("find (script)", script + ["find", word, "in", path, option]),
+            ("find", imported + ["find", word, "in", path, option]),
+            ("find (missing)", imported + ["find", "missingword", "in", path, option]),
+            ("list max 10", imported + ["list", "in", path, "max", "10", option]),
+        ]
+        timings = [(name, time_process(argv, repeat)) for (name, argv) in commands]
+    finally:
+        shutil.rmtree(work)
+
+    return {
+        "benchmark": "startup",
+        "python": sys.version.split()[0],
+        "repeat": repeat,
+        "corpus": corpus,
+        "commands": [{"command": name, "wall": seconds} for (name, seconds) in timings],
+    }
+
+def print_startup_results(results):
+    """
+    Prints the results of the start-up benchmark as a table.
+    """
+    corpus = results["corpus"]
+    print "Corpus: %d files, %.2f MB, %d words, vocabulary %d, zipf %.2f" % (
+        corpus["files"], corpus["bytes"] / 1048576.0, corpus["words"], corpus["vocabulary"], corpus["zipf"])
+    print "{:16} {:>10}".format("command", "wall (ms)")
+    for result in results["commands"]:
+        print "{:16} {:10.1f}".format(result["command"], result["wall"] * 1000)
+
+if (__name__ == "__main__"):
+    params = docopt(__doc__)
+
+    corpus_settings = {
+        "files": int(params["--files"]),
+        "size": int(params["--size"]) * 1024,
+        "vocabulary": int(params["--vocabulary"]),
+        "zipf": float(params["--zipf"]),
+        "seed": int(params["--seed"]),
+    }
+
+    if params["tokenizer"]:
+        lines = make_lines(int(params["--lines"]), int(params["--seed"]))
+        benchmark_tokenizer(lines, int(params["--repeat"]))
+    elif params["corpus"]:
+        print json.dumps(make_corpus(params["<path>"], **corpus_settings), indent=2, sort_keys=True)
+    elif params["commands"] or params["startup"]:
+        path = params["<path>"]
+        if path:
+            remove = False
+            if not os.path.exists(path):
+                os.makedirs(path)
+        else:
+            remove = True
+            path = tempfile.mkdtemp(prefix="dexter-corpus-")
+        try:
+            if params["commands"]:
+                results = benchmark_commands(path, corpus_settings, params["--format"],
+                    int(params["--jobs"]), int(params["--lookups"]))
+            else:
+                results = benchmark_startup(path, corpus_settings, int(params["--repeat"]))
+        finally:
+            if remove:
+                shutil.rmtree(path)
+        if params["commands"]:
+            print_command_results(results)
+        else:
+            print_startup_results(results)
+        if params["--output"]:
+            with open(params["--output"], "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
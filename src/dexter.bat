@@ -1,2 +1,3 @@
-@rem Simple batch file for calling the dexter.py script
-@python dexter.py %1 %2 %3 %4 %5 %6 %7 %8 %9
+@rem Simple batch file for calling the dexter.py script (importing it, so that
+@rem Python can reuse its compiled form, which starts up faster)
+@python -c "import dexter; dexter.main()" %1 %2 %3 %4 %5 %6 %7 %8 %9
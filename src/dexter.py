@@ -4,36 +4,258 @@
 Text-file indexer
 
 Usage:
-  dexter [-vr] index [<path>] [--ignore=IGNOREFILE]
-  dexter [-vri] find <word> [in <path>] [--ignore=IGNOREFILE]
-  dexter [-vria] list [in <path>] [max <count>] [--ignore=IGNOREFILE]
+  dexter [-vrf] index [<path>] [--fuzzy] [--stats] [--ignore=IGNOREFILE] [--format=FORMAT] [--jobs=N] [--readers=N] [--memory=MB] [--max-size=MB] [--positions] [--shards=DEPTH]
+  dexter [-vrif] find <word> [in <path>] [--fuzzy] [--distance=K] [--stats] [--ignore=IGNOREFILE] [--format=FORMAT] [--jobs=N] [--readers=N] [--memory=MB] [--max-size=MB] [--positions] [--shards=DEPTH]
+  dexter [-vriaf] list [in <path>] [max <count>] [--by=ORDER] [--stats] [--ignore=IGNOREFILE] [--format=FORMAT] [--jobs=N] [--readers=N] [--memory=MB] [--max-size=MB] [--positions] [--shards=DEPTH]
+  dexter [-vrf] serve [<path>] [--socket=SOCKFILE] [--ignore=IGNOREFILE] [--format=FORMAT] [--jobs=N] [--readers=N] [--memory=MB] [--max-size=MB] [--positions] [--shards=DEPTH]
+  dexter [-vrf] watch [<path>] [--interval=SECONDS] [--stats] [--ignore=IGNOREFILE] [--format=FORMAT] [--jobs=N] [--readers=N] [--max-size=MB] [--positions] [--shards=DEPTH]
+  dexter client find <word> [in <path>] [--socket=SOCKFILE]
+  dexter [-a] client list [in <path>] [max <count>] [--by=ORDER] [--socket=SOCKFILE]
   dexter -h | --help
   dexter --version
 
 Options:
   index [<path>]  Creates an index file for the specified path
-  find <word> [in <path>] Searches for the specified word
+  find <word> [in <path>] Searches for the specified word. The word can be
+                a pattern, using '*' to match any letters and '?' to match
+                a single letter, such as 'conf*' or '*tion', or a query of
+                several words joined by AND, OR and NOT, such as
+                'open AND file NOT close'. If the index has positions, a
+                query can also include quoted phrases, such as
+                '"connection reset"', and pairs of words within a number
+                of words of each other, such as 'connection NEAR/3 reset'
   list [in <path>] [max <count>] Lists all the words found
+  serve [<path>]  Loads the index and answers 'find' and 'list' requests
+                from 'client' over a local socket, until interrupted
+  client          Sends a 'find' or 'list' request to a running server
+  watch [<path>]  Builds or updates the index, and then keeps it up to date
+                as files are changed, added and removed, until interrupted
   -h --help     Show this screen
   --version     Show version
   -v --verbose  Show messages
   -r --recurse  Recurse into sub-directories
   -i --reindex  For 'find' and 'list' forces a reindex even if an index exists
+  -f --full     Rebuild the whole index instead of updating it from the manifest
   -a --abbrev   Show abbreviated list (word, line, and filename only, no path)
+  --stats       Show the time taken by each phase of the command, and counts
+                of the files, words and locations processed
   --ignore=IGNOREFILE Use specified ignore-words file instead of the default
+  --format=FORMAT Index file format, 'text' (dexter.index), 'binary'
+                (dexter.bindex) or 'compressed' (dexter.bindex, with the
+                line numbers delta-encoded and packed into as few bytes as
+                possible). Defaults to the format of the existing index
+  --jobs=N      Number of processes to scan the files with [default: 1]
+  --readers=N   Number of threads to read the files ahead of scanning them
+                with, so that waiting for slow (such as network) storage
+                overlaps with the scanning. Used when --jobs is 1
+  --memory=MB   Memory budget for building the index, in megabytes. When it
+                is exceeded the words found so far are written out to a
+                temporary file, and the files are merged at the end. The
+                budget is shared between the processes given by --jobs
+  --max-size=MB Skip files larger than this size, in megabytes
+  --by=ORDER     Order for 'list': 'word', or 'freq' (most often found first)
+                or 'files' (found in the most files first), which list each
+                word with the number of times and of files it was found in,
+                rather than with its locations [default: word]
+  --fuzzy       For 'find', lists the words within the edit distance of the
+                word, with their locations. For 'index', builds the table of
+                misspellings used for this, which is otherwise built by
+                the first 'find --fuzzy'. Once built it is kept up to date
+  --distance=K  Maximum number of letters which can be inserted, deleted,
+                changed or swapped for 'find --fuzzy' [default: 1]
+  --shards=DEPTH Index each folder at this depth below the path (with its
+                sub-folders) separately, along with the files above them,
+                listing the folders in a dexter.shards catalog. Implies -r.
+                Updates only rewrite the indexes of folders which changed,
+                and searches read the indexes in parallel with --jobs.
+                Defaults to the depth in the existing catalog. Use 0 to go
+                back to a single index
+  --positions   Record the position of each word within its line, for phrase
+                and NEAR queries. An index which has positions keeps them
+                when it is updated, unless it is rebuilt with --full
+  --interval=SECONDS  For 'watch', how long to wait after a change for any
+                further changes before rewriting the index, and how often to
+                look for changes when inotify cannot be used [default: 2]
+  --socket=SOCKFILE Socket for 'serve' and 'client' to communicate over,
+                instead of the default (dexter.sock in the path)
 """
 
 # Standard library imports
 import os
-import glob
+import stat
 import collections
 import re
+import mmap
+import struct
+import marshal
+import array
+import sys
+import heapq
+import itertools
+import signal
+import time
+import fnmatch
+import hashlib
+import select
+import errno
+
+# The multiprocessing, socket, tempfile, threading, Queue and ctypes modules
+# are only needed by some commands, and are imported by the functions which
+# use them, so that other commands (such as a 'find' in an existing index,
+# run by an editor on every keystroke) start faster
 
 # Third party imports
 from docopt import docopt
 
+# Optional imports: os.scandir is only available from Python 3.5, but the
+# scandir package provides it for earlier versions
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 # Application specific imports
 
+# Version of the compiled ignore-words cache, changed whenever the layout of
+# the cache changes
+IGNORE_CACHE_VERSION = 1
+
+# Files which Dexter creates in the indexed directory, and which must not be
+# indexed themselves
+DEXTER_FILES = ("dexter.index", "dexter.suffixes", "dexter.bindex", "dexter.manifest", "dexter.sniff",
+    "dexter.sock", "dexter.fuzzy", "dexter.shards", "dexter.bloom")
+
+# Files which make up the index of a shard (see Dexter.make_shards)
+SHARD_FILES = ("dexter.index", "dexter.suffixes", "dexter.bindex", "dexter.manifest", "dexter.sniff",
+    "dexter.bloom")
+
+# Temporary files which Dexter creates while building the index: the runs
+# written when the memory budget is exceeded, and the new index files which
+# replace the old ones once they are complete
+RUN_PREFIX = "dexter-"
+RUN_SUFFIX = ".run"
+TEMP_SUFFIX = ".tmp"
+
+# Orders in which 'list' can show the words (see --by)
+LIST_ORDERS = ("word", "freq", "files")
+
+# Characters which make a word to search for into a pattern
+WILDCARDS = "*?["
+
+# Largest edit distance which the dexter.fuzzy table can be searched with
+FUZZY_DISTANCE = 2
+
+# Number of dexter.fuzzy records which are sorted in memory at a time; more
+# are sorted in runs, which are then merged (see sort_records)
+FUZZY_RUN_SIZE = 1000000
+
+# Number of --interval periods for which 'watch' lets changes wait while
+# more keep arriving, before rewriting the index anyway
+WATCH_MAX_DELAY = 10
+
+# Files of at least LARGE_FILE_SIZE bytes are scanned through a memory map,
+# SCAN_CHUNK_SIZE bytes at a time (see Dexter.scan_large_file)
+LARGE_FILE_SIZE = 16 * 1048576
+SCAN_CHUNK_SIZE = 4 * 1048576
+
+# Words which are not indexed, unless the ignore file says otherwise. These
+# are written to the default ignore file if there is not one yet
+DEFAULT_IGNORE_WORDS = ("able", "about", "above", "according",
+    "accordingly", "across", "actually", "after", "afterwards",
+    "again", "against", "ain’t", "all", "allow", "allows", "almost",
+    "alone", "along", "already", "also", "although", "always", "am",
+    "among", "amongst", "an", "and", "another", "any", "anybody",
+    "anyhow", "anyone", "anything", "anyway", "anyways", "anywhere",
+    "apart", "appear", "appreciate", "appropriate", "are", "aren’t",
+    "around", "as", "aside", "ask", "asking", "associated", "at",
+    "available", "away", "awfully", "be", "became", "because",
+    "become", "becomes", "becoming", "been", "before", "beforehand",
+    "behind", "being", "believe", "below", "beside", "besides",
+    "best", "better", "between", "beyond", "both", "brief", "but",
+    "by", "c’mon", "c’s", "came", "can", "can’t", "cannot", "cant",
+    "cause", "causes", "certain", "certainly", "changes", "clearly",
+    "co", "com", "come", "comes", "concerning", "consequently",
+    "consider", "considering", "contain", "containing", "contains",
+    "corresponding", "could", "couldn’t", "course", "currently",
+    "definitely", "described", "despite", "did", "didn’t",
+    "different", "do", "does", "doesn’t", "doing", "don’t", "done",
+    "down", "downwards", "during", "each", "edu", "eg", "eight",
+    "either", "else", "elsewhere", "enough", "entirely", "especially",
+    "et", "etc", "even", "ever", "every", "everybody", "everyone",
+    "everything", "everywhere", "ex", "exactly", "example", "except",
+    "far", "few", "fifth", "first", "five", "followed", "following",
+    "follows", "for", "former", "formerly", "forth", "four", "from",
+    "further", "furthermore", "get", "gets", "getting", "given",
+    "gives", "go", "goes", "going", "gone", "got", "gotten",
+    "greetings", "had", "hadn’t", "happens", "hardly", "has",
+    "hasn’t", "have", "haven’t", "having", "he", "he’s", "hello",
+    "help", "hence", "her", "here", "here’s", "hereafter", "hereby",
+    "herein", "hereupon", "hers", "herself", "hi", "him", "himself",
+    "his", "hither", "hopefully", "how", "howbeit", "however", "i’d",
+    "i’ll", "i’m", "i’ve", "ie", "if", "ignored", "immediate", "in",
+    "inasmuch", "inc", "indeed", "indicate", "indicated", "indicates",
+    "inner", "insofar", "instead", "into", "inward", "is", "isn’t",
+    "it", "it’d", "it’ll", "it’s", "its", "itself", "just", "keep",
+    "keeps", "kept", "know", "knows", "known", "last", "lately",
+    "later", "latter", "latterly", "least", "less", "lest", "let",
+    "let’s", "like", "liked", "likely", "little", "look", "looking",
+    "looks", "ltd", "mainly", "many", "may", "maybe", "me", "mean",
+    "meanwhile", "merely", "might", "more", "moreover", "most",
+    "mostly", "much", "must", "my", "myself", "name", "namely", "nd",
+    "near", "nearly", "necessary", "need", "needs", "neither",
+    "never", "nevertheless", "new", "next", "nine", "no", "nobody",
+    "non", "none", "noone", "nor", "normally", "not", "nothing",
+    "novel", "now", "nowhere", "obviously", "of", "off", "often",
+    "oh", "ok", "okay", "old", "on", "once", "one", "ones", "only",
+    "onto", "or", "other", "others", "otherwise", "ought", "our",
+    "ours", "ourselves", "out", "outside", "over", "overall", "own",
+    "particular", "particularly", "per", "perhaps", "placed",
+    "please", "plus", "possible", "presumably", "probably",
+    "provides", "que", "quite", "qv", "rather", "rd", "re", "really",
+    "reasonably", "regarding", "regardless", "regards", "relatively",
+    "respectively", "right", "said", "same", "saw", "say", "saying",
+    "says", "second", "secondly", "see", "seeing", "seem", "seemed",
+    "seeming", "seems", "seen", "self", "selves", "sensible", "sent",
+    "serious", "seriously", "seven", "several", "shall", "she",
+    "should", "shouldn’t", "since", "six", "so", "some", "somebody",
+    "somehow", "someone", "something", "sometime", "sometimes",
+    "somewhat", "somewhere", "soon", "sorry", "specified", "specify",
+    "specifying", "still", "sub", "such", "sup", "sure", "t’s",
+    "take", "taken", "tell", "tends", "th", "than", "thank", "thanks",
+    "thanx", "that", "that’s", "thats", "the", "their", "theirs",
+    "them", "themselves", "then", "thence", "there", "there’s",
+    "thereafter", "thereby", "therefore", "therein", "theres",
+    "thereupon", "these", "they", "they’d", "they’ll", "they’re",
+    "they’ve", "think", "third", "this", "thorough", "thoroughly",
+    "those", "though", "three", "through", "throughout", "thru",
+    "thus", "to", "together", "too", "took", "toward", "towards",
+    "tried", "tries", "truly", "try", "trying", "twice", "two", "un",
+    "under", "unfortunately", "unless", "unlikely", "until", "unto",
+    "up", "upon", "us", "use", "used", "useful", "uses", "using",
+    "usually", "value", "various", "very", "via", "viz", "vs", "want",
+    "wants", "was", "wasn’t", "way", "we", "we’d", "we’ll", "we’re",
+    "we’ve", "welcome", "well", "went", "were", "weren’t", "what",
+    "what’s", "whatever", "when", "whence", "whenever", "where",
+    "where’s", "whereafter", "whereas", "whereby", "wherein",
+    "whereupon", "wherever", "whether", "which", "while", "whither",
+    "who", "who’s", "whoever", "whole", "whom", "whose", "why",
+    "will", "willing", "wish", "with", "within", "without", "won’t",
+    "wonder", "would", "would", "wouldn’t", "yes", "yet", "you",
+    "you’d", "you’ll", "you’re", "you’ve", "your", "yours",
+    "yourself", "yourselves", "zero")
+
+# Number of files which each --readers thread may read ahead of the scanning
+READ_AHEAD = 4
+
+# Number of bytes examined at the start of a file to decide whether it is a
+# text file, and the characters which are expected in a text file (anything
+# other than control characters, apart from the usual whitespace ones)
+SNIFF_SIZE = 4096
+TEXT_CHARACTERS = "".join(chr(c) for c in [7, 8, 9, 10, 12, 13, 27] + range(32, 127) + range(128, 256))
+
 class Dexter():
 
     """
@@ -48,96 +270,55 @@ class Dexter():
         """
         Main entry point. 
 
+        params - a fully-populated docopt params object
+        """
+        # Ensure we have valid options
+        if self.setup(params):
+            
+            # Call the requested command
+            if self.params["index"]:
+                self.make_index()
+            elif self.params["client"]:
+                self.send_request()
+            elif self.params["find"]:
+                self.find_word()
+            elif self.params["list"]:
+                self.list_words()
+            elif self.params["serve"]:
+                self.serve()
+            elif self.params["watch"]:
+                self.watch()
+
+            if self.stats:
+                if self.dictionary is not None:
+                    self.stats.set_totals(self.dictionary)
+                self.stats.report(sys.stderr)
+                
+        return True
+
+    def setup(self, params):
+        """
+        Prepares for running a command, without running it. Returns True if
+        the options are valid, otherwise prints an error message and returns
+        False. This allows other scripts (such as the benchmarks) to call the
+        individual functions directly.
+
         params - a fully-populated docopt params object
         """
         self.params = params
 
-        self.dictionary = {}
-
-        self.ignore_words = [ "able", "about", "above", "according",
-            "accordingly", "across", "actually", "after", "afterwards",
-            "again", "against", "ain’t", "all", "allow", "allows", "almost",
-            "alone", "along", "already", "also", "although", "always", "am",
-            "among", "amongst", "an", "and", "another", "any", "anybody",
-            "anyhow", "anyone", "anything", "anyway", "anyways", "anywhere",
-            "apart", "appear", "appreciate", "appropriate", "are", "aren’t",
-            "around", "as", "aside", "ask", "asking", "associated", "at",
-            "available", "away", "awfully", "be", "became", "because",
-            "become", "becomes", "becoming", "been", "before", "beforehand",
-            "behind", "being", "believe", "below", "beside", "besides",
-            "best", "better", "between", "beyond", "both", "brief", "but",
-            "by", "c’mon", "c’s", "came", "can", "can’t", "cannot", "cant",
-            "cause", "causes", "certain", "certainly", "changes", "clearly",
-            "co", "com", "come", "comes", "concerning", "consequently",
-            "consider", "considering", "contain", "containing", "contains",
-            "corresponding", "could", "couldn’t", "course", "currently",
-            "definitely", "described", "despite", "did", "didn’t",
-            "different", "do", "does", "doesn’t", "doing", "don’t", "done",
-            "down", "downwards", "during", "each", "edu", "eg", "eight",
-            "either", "else", "elsewhere", "enough", "entirely", "especially",
-            "et", "etc", "even", "ever", "every", "everybody", "everyone",
-            "everything", "everywhere", "ex", "exactly", "example", "except",
-            "far", "few", "fifth", "first", "five", "followed", "following",
-            "follows", "for", "former", "formerly", "forth", "four", "from",
-            "further", "furthermore", "get", "gets", "getting", "given",
-            "gives", "go", "goes", "going", "gone", "got", "gotten",
-            "greetings", "had", "hadn’t", "happens", "hardly", "has",
-            "hasn’t", "have", "haven’t", "having", "he", "he’s", "hello",
-            "help", "hence", "her", "here", "here’s", "hereafter", "hereby",
-            "herein", "hereupon", "hers", "herself", "hi", "him", "himself",
-            "his", "hither", "hopefully", "how", "howbeit", "however", "i’d",
-            "i’ll", "i’m", "i’ve", "ie", "if", "ignored", "immediate", "in",
-            "inasmuch", "inc", "indeed", "indicate", "indicated", "indicates",
-            "inner", "insofar", "instead", "into", "inward", "is", "isn’t",
-            "it", "it’d", "it’ll", "it’s", "its", "itself", "just", "keep",
-            "keeps", "kept", "know", "knows", "known", "last", "lately",
-            "later", "latter", "latterly", "least", "less", "lest", "let",
-            "let’s", "like", "liked", "likely", "little", "look", "looking",
-            "looks", "ltd", "mainly", "many", "may", "maybe", "me", "mean",
-            "meanwhile", "merely", "might", "more", "moreover", "most",
-            "mostly", "much", "must", "my", "myself", "name", "namely", "nd",
-            "near", "nearly", "necessary", "need", "needs", "neither",
-            "never", "nevertheless", "new", "next", "nine", "no", "nobody",
-            "non", "none", "noone", "nor", "normally", "not", "nothing",
-            "novel", "now", "nowhere", "obviously", "of", "off", "often",
-            "oh", "ok", "okay", "old", "on", "once", "one", "ones", "only",
-            "onto", "or", "other", "others", "otherwise", "ought", "our",
-            "ours", "ourselves", "out", "outside", "over", "overall", "own",
-            "particular", "particularly", "per", "perhaps", "placed",
-            "please", "plus", "possible", "presumably", "probably",
-            "provides", "que", "quite", "qv", "rather", "rd", "re", "really",
-            "reasonably", "regarding", "regardless", "regards", "relatively",
-            "respectively", "right", "said", "same", "saw", "say", "saying",
-            "says", "second", "secondly", "see", "seeing", "seem", "seemed",
-            "seeming", "seems", "seen", "self", "selves", "sensible", "sent",
-            "serious", "seriously", "seven", "several", "shall", "she",
-            "should", "shouldn’t", "since", "six", "so", "some", "somebody",
-            "somehow", "someone", "something", "sometime", "sometimes",
-            "somewhat", "somewhere", "soon", "sorry", "specified", "specify",
-            "specifying", "still", "sub", "such", "sup", "sure", "t’s",
-            "take", "taken", "tell", "tends", "th", "than", "thank", "thanks",
-            "thanx", "that", "that’s", "thats", "the", "their", "theirs",
-            "them", "themselves", "then", "thence", "there", "there’s",
-            "thereafter", "thereby", "therefore", "therein", "theres",
-            "thereupon", "these", "they", "they’d", "they’ll", "they’re",
-            "they’ve", "think", "third", "this", "thorough", "thoroughly",
-            "those", "though", "three", "through", "throughout", "thru",
-            "thus", "to", "together", "too", "took", "toward", "towards",
-            "tried", "tries", "truly", "try", "trying", "twice", "two", "un",
-            "under", "unfortunately", "unless", "unlikely", "until", "unto",
-            "up", "upon", "us", "use", "used", "useful", "uses", "using",
-            "usually", "value", "various", "very", "via", "viz", "vs", "want",
-            "wants", "was", "wasn’t", "way", "we", "we’d", "we’ll", "we’re",
-            "we’ve", "welcome", "well", "went", "were", "weren’t", "what",
-            "what’s", "whatever", "when", "whence", "whenever", "where",
-            "where’s", "whereafter", "whereas", "whereby", "wherein",
-            "whereupon", "wherever", "whether", "which", "while", "whither",
-            "who", "who’s", "whoever", "whole", "whom", "whose", "why",
-            "will", "willing", "wish", "with", "within", "without", "won’t",
-            "wonder", "would", "would", "wouldn’t", "yes", "yet", "you",
-            "you’d", "you’ll", "you’re", "you’ve", "your", "yours",
-            "yourself", "yourselves", "zero" ]
-        
+        self.dictionary = Postings()
+        self.manifest = {}
+        self.sniffed = {}
+        self.sniff_cache = {}
+        self.runs = []
+        self.merge_existing = False
+        self.stale = set()
+
+        # The ignore words are only read when they are first needed (see
+        # load_ignore_words)
+        self.ignore_words = None
+
         # Retrieve the command-line options
         self.verbose = self.params["--verbose"]
         self.recurse = self.params["--recurse"]
@@ -145,50 +326,385 @@ class Dexter():
         self.path = self.params["<path>"]
         self.word = self.params["<word>"]
         self.reindex = self.params["--reindex"]
+        self.full = self.params["--full"]
         self.count = self.params["<count>"]
         if not self.count:
             self.count = -1
         else:
             self.count = int(self.count)
         self.ignore_file = self.params["--ignore"]
+        self.format = self.params["--format"]
+        self.compress = False
+        self.jobs = self.params["--jobs"]
+        self.readers = self.params["--readers"]
+        self.memory = self.params["--memory"]
+        self.max_size = self.params["--max-size"]
+        self.positions = self.params["--positions"]
+        self.fuzzy = self.params["--fuzzy"]
+        self.by = self.params["--by"]
+        self.shards = self.params["--shards"]
+        self.walk_depth = None
+        self.distance = self.params["--distance"]
+        self.interval = self.params["--interval"]
+        self.socket = self.params.get("--socket")
+        if self.params.get("--stats"):
+            self.stats = Statistics()
+        else:
+            self.stats = None
+        self.output = sys.stdout
 
-        self.read_ignore_file()
+        self.tokenizer = Tokenizer()
 
-        # Ensure we have valid options
-        if self.verify_path():
-            
-            # Call the requested command
-            if self.params["index"]:
-                self.make_index()
-            elif self.params["find"]:
-                self.find_word()
-            elif self.params["list"]:
-                self.list_words()
-                
-        return True
+        return (self.verify_path() and self.verify_shards() and self.verify_format() and self.verify_jobs() and
+            self.verify_readers() and self.verify_memory() and self.verify_max_size() and self.verify_distance() and
+            self.verify_by() and self.verify_interval())
 
     def make_index(self):
         """
         Creates an index file in the target path, populating it from
         the contents of the text-files found in the path.
+
+        If an index and a manifest from a previous run exist (and the --full
+        option has not been specified) the existing index is updated instead,
+        only rescanning the files which have been added or changed since.
+
+        An index without positions is rebuilt from scratch if positions have
+        been asked for.
+
+        The table of misspellings for 'find --fuzzy' (dexter.fuzzy) is
+        rebuilt from the new index if it was asked for or already exists.
+
+        If nothing has changed since an existing index was built, it is left
+        as it is. If the index is sharded, each shard is built instead (see
+        make_shards).
+
+        If a memory budget has been set, the dictionary is written out to a
+        temporary 'run' file whenever it grows beyond the budget, and the
+        runs are merged into the final index by save_index(). An existing
+        index is then not loaded, but merged in as though it were a run. In
+        this case the dictionary is set to None once the index is saved, as
+        it no longer holds all the words.
         """
+        if self.shards:
+            self.make_shards()
+            return
+        if self.shards == 0 and self.catalog_exists():
+            self.remove_shards()
+
         self.report("Building index for %s" % self.path)
-        files = self.get_files(self.path)
-        self.index_files(files)
-        self.save_index()
+        self.read_index_options()
+        self.dictionary = Postings(self.positions)
+        self.runs = []
+        self.merge_existing = False
+        if (self.full or not (self.index_exists() and self.manifest_exists()) or
+                self.index_has_positions() != self.positions):
+            self.manifest = {}
+        elif self.read_manifest_ignore() != self.ignore_signature():
+            # The unchanged files would otherwise stay indexed under the old
+            # ignore words
+            self.report("The ignore words have changed, so rebuilding the index")
+            self.manifest = {}
+        else:
+            if self.memory:
+                self.merge_existing = True
+            else:
+                self.timed("load", self.read_index)
+            self.read_manifest()
+        if self.sniff_cache_exists():
+            self.read_sniff_cache()
+        self.sniffed = {}
+        self.index_files(self.walk_files(self.path))
+
+        # Nothing needs saving if no files have changed, unless the index is
+        # to be rewritten with different options
+        if (self.changed or self.full or not self.index_exists() or
+                self.params["--format"] or self.params["--positions"]):
+            self.timed("save", self.save_index)
+            # The dexter.fuzzy file at the top of a sharded index covers all
+            # the shards, so it is saved by make_shards(), not by the shard
+            # at the top (the only one with a walk depth)
+            if (self.fuzzy or self.fuzzy_exists()) and self.walk_depth is None:
+                self.timed("save", self.save_fuzzy)
+            self.save_manifest()
+            self.save_sniff_cache()
+        else:
+            self.report("No changes to %s" % self.path)
+            if self.merge_existing:
+                self.dictionary = None
+            if self.fuzzy and not self.fuzzy_exists():
+                self.timed("save", self.save_fuzzy)
+
+    def make_shards(self):
+        """
+        Builds a sharded index. Each folder at the shard depth below the path
+        is a shard, with its own index (and manifest) covering the folder and
+        its sub-folders, and the files above those folders make up the shard
+        for the path itself. The shards are listed in a dexter.shards catalog
+        in the path, and are built by a pool of processes if there is more
+        than one job.
+
+        Each shard is updated from its own manifest, so a shard in which
+        nothing has changed is not rewritten.
+        """
+        self.report("Building sharded index for %s" % self.path)
+        folders = self.find_shards()
+        if self.catalog_exists():
+            (depth, old_folders) = self.read_catalog()
+            for folder in set(old_folders) - set(folders):
+                self.remove_shard(os.path.join(self.path, folder))
+        self.save_catalog(folders)
+
+        params = dict(self.params)
+        shards = [(params, self.path, self.shards)]
+        shards.extend((params, os.path.join(self.path, folder), None) for folder in folders)
+        if self.jobs > 1 and len(shards) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(self.jobs)
+            try:
+                pool.map(index_shard, shards)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for shard in shards:
+                index_shard(shard)
+
+        # The words are in the indexes of the shards, rather than in the
+        # dictionary
+        self.dictionary = None
+        if self.fuzzy or self.fuzzy_exists():
+            self.timed("save", self.save_fuzzy)
+
+    def find_shards(self):
+        """
+        Returns the sorted list of the folders at the shard depth below the
+        path, relative to the path.
+        """
+        shards = []
+        folders = [(self.path, 0)]
+        while folders:
+            (folder, depth) = folders.pop()
+            for (filespec, is_dir) in self.list_folder(folder):
+                if is_dir:
+                    if depth + 1 == self.shards:
+                        shards.append(os.path.relpath(filespec, self.path))
+                    else:
+                        folders.append((filespec, depth + 1))
+        return sorted(shards)
+
+    def remove_shards(self):
+        """
+        Deletes the indexes of all the shards listed in the catalog, and the
+        catalog itself, leaving the index of the path to be rebuilt as a
+        single index.
+        """
+        (depth, folders) = self.read_catalog()
+        for folder in folders:
+            self.remove_shard(os.path.join(self.path, folder))
+        os.remove(os.path.join(self.path, "dexter.shards"))
+
+    def remove_shard(self, path):
+        """
+        Deletes the index files of the shard in the specified path.
+        """
+        for filename in SHARD_FILES:
+            filespec = os.path.join(path, filename)
+            if os.path.exists(filespec):
+                os.remove(filespec)
 
     def index_files(self, file_list):
         """
         Scans the text-files found in the supplied list, recursively
         scanning any sub-folders found, provided the recurse option
         has been set.
+
+        Files whose size, modification time and inode match the entry in the
+        manifest are skipped. The entries for changed and deleted files are
+        removed from the dictionary before the changed files are rescanned.
+        Sets changed to True if any files were added, changed or deleted.
         """
-        for filespec in file_list:
-            if os.path.isdir(filespec) and self.recurse:
-                self.report("Building index for %s" % filespec)
-                self.index_files(self.get_files(filespec))
+        signatures = collections.OrderedDict()
+        self.timed("walk", self.collect_signatures, file_list, signatures)
+
+        # Anything in the manifest which has changed or is no longer present
+        # is stale, and must be dropped from the dictionary
+        stale = [filespec for filespec in self.manifest if signatures.get(filespec) != self.manifest[filespec]]
+        self.remove_files(stale)
+        self.stale = set(stale)
+
+        changed = []
+        for filespec, signature in signatures.iteritems():
+            if self.manifest.get(filespec) != signature:
+                changed.append(filespec)
             else:
+                self.report("Skipping unchanged %s" % filespec)
+        self.scan_files(changed)
+
+        self.changed = bool(changed or stale)
+        self.manifest = signatures
+
+    def update_files(self, filespecs):
+        """
+        Brings the dictionary and the manifest up to date for the supplied
+        files and folders, which are known to have changed, without walking
+        the rest of the path. Folders are walked (when the recurse option has
+        been set), and the entries for files which have been removed, or
+        which were in folders which have been removed, are dropped. Sets
+        changed to True if any files were added, changed or removed.
+        """
+        signatures = {}
+        indexed = set()
+        for filespec in filespecs:
+            if os.path.isdir(filespec):
+                prefix = os.path.join(filespec, "")
+                indexed.update(name for name in self.manifest if name.startswith(prefix))
+                if self.recurse or filespec == self.path:
+                    signatures.update(self.walk_files(filespec))
+                continue
+            if filespec in self.manifest:
+                indexed.add(filespec)
+            elif not os.path.exists(filespec):
+                # This may have been a folder
+                prefix = os.path.join(filespec, "")
+                indexed.update(name for name in self.manifest if name.startswith(prefix))
+            try:
+                signature = self.file_signature(filespec)
+            except OSError:
+                continue
+            if self.is_textfile(filespec, signature):
+                signatures[filespec] = signature
+
+        stale = [filespec for filespec in indexed if signatures.get(filespec) != self.manifest[filespec]]
+        self.remove_files(stale)
+        for filespec in stale:
+            del self.manifest[filespec]
+
+        changed = [filespec for filespec in signatures if self.manifest.get(filespec) != signatures[filespec]]
+        self.scan_files(changed)
+        for filespec in changed:
+            self.manifest[filespec] = signatures[filespec]
+        self.changed = bool(changed or stale)
+
+    def scan_files(self, file_list):
+        """
+        Scans the supplied files, using a pool of worker processes if there
+        is more than one job and more than one file, or otherwise reading the
+        files ahead with threads if there are any readers.
+        """
+        self.load_ignore_words()
+        if self.jobs > 1 and len(file_list) > 1:
+            self.scan_files_parallel(file_list)
+        elif self.readers and len(file_list) > 1:
+            self.scan_files_pipelined(file_list)
+        else:
+            for filespec in file_list:
                 self.scan_file(filespec)
+                self.check_memory()
+
+    def scan_files_parallel(self, file_list):
+        """
+        Scans the supplied files using a pool of worker processes. The files
+        are split into chunks, each worker builds a partial dictionary for
+        each chunk it is given, and the partial dictionaries are merged into
+        the main dictionary in the original file order.
+
+        If a memory budget has been set, it is shared between the workers,
+        which write their partial dictionaries out as runs instead (see
+        flush_run), so that neither the workers nor the partial dictionaries
+        waiting to be merged can grow beyond it. The runs of each chunk are
+        added after those of the files before it, keeping the file order.
+        """
+        import multiprocessing
+        self.report("Scanning %d files with %d processes" % (len(file_list), self.jobs))
+        chunk_size = max(1, len(file_list) // (self.jobs * 4))
+        chunks = [file_list[i:i + chunk_size] for i in xrange(0, len(file_list), chunk_size)]
+        pool = multiprocessing.Pool(self.jobs, init_worker,
+            (self.ignore_words, self.verbose, self.stats is not None, self.positions, self.path,
+            self.memory // self.jobs if self.memory else None))
+        try:
+            for (partial, runs, stats) in pool.imap(scan_chunk, chunks):
+                if stats:
+                    self.stats.merge(stats)
+                if runs:
+                    if len(self.dictionary):
+                        self.flush_run()
+                    self.runs.extend(runs)
+                if partial is not None:
+                    self.timed("merge", self.dictionary.merge, partial)
+                    self.check_memory()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def scan_files_pipelined(self, file_list):
+        """
+        Scans the supplied files, in order, while a pool of reader threads
+        reads the files which come next. Each file is handed to the readers
+        along with a single-item queue for its contents, and the queues are
+        kept in order, so the scanning only ever waits for the file it needs
+        next. No more than READ_AHEAD files per reader are handed out ahead
+        of the scanning, which limits the memory used by the files waiting
+        to be scanned.
+
+        Large files (see scan_large_file) are not read by the readers, but
+        scanned in chunks as usual.
+        """
+        import threading
+        import Queue
+        self.report("Scanning %d files with %d readers" % (len(file_list), self.readers))
+        requests = Queue.Queue()
+        readers = [threading.Thread(target=read_files, args=(requests,)) for i in xrange(self.readers)]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+        waiting = collections.deque()
+        try:
+            for filespec in file_list:
+                contents = Queue.Queue(1)
+                requests.put((filespec, contents))
+                waiting.append((filespec, contents))
+                if len(waiting) < self.readers * READ_AHEAD:
+                    continue
+                self.scan_next(waiting)
+            while waiting:
+                self.scan_next(waiting)
+        finally:
+            for reader in readers:
+                requests.put(None)
+
+    def scan_next(self, waiting):
+        """
+        Waits for the contents of the first file in the supplied queue of
+        files being read by scan_files_pipelined, and scans it.
+        """
+        (filespec, contents) = waiting.popleft()
+        (text, error) = self.timed("read", contents.get)
+        if error:
+            raise error
+        self.report("Scanning %s" % filespec)
+        if text is None:
+            self.scan_large_file(filespec)
+        else:
+            if self.stats:
+                self.stats.count("files")
+                self.stats.count("bytes", len(text))
+            self.scan_text(filespec, text)
+        self.check_memory()
+
+    def collect_signatures(self, file_list, signatures):
+        """
+        Adds the signature of each text-file in the supplied list (or other
+        iterable) of (filespec, signature) tuples to the signatures
+        dictionary.
+        """
+        for filespec, signature in file_list:
+            signatures[filespec] = signature
             
     def find_word(self):
         """
@@ -198,35 +714,149 @@ class Dexter():
         """
         self.report("Searching for %s" % self.word)
 
+        # If the index has to be built, the words will usually still be in
+        # the dictionary afterwards. Otherwise the word is looked up directly
+        # in the index file, without loading it
+        index = None
         if self.reindex or not self.index_exists():
             self.make_index()
         else:
-            self.read_index()
-        
+            # Most searches for single words which are not in the index can
+            # be answered from the Bloom filter, without opening the index
+            if not (self.fuzzy or is_query(self.word) or is_pattern(self.word) or
+                    self.word_may_exist(self.word.lower())):
+                self.timed("search", self.show_locations, Postings())
+                return
+            self.dictionary = None
+            if self.fuzzy and not self.fuzzy_exists():
+                self.timed("save", self.save_fuzzy)
+        if self.dictionary is None:
+            index = self.open_index()
+        else:
+            index = self.dictionary
+
+        try:
+            self.timed("search", self.search, index)
+        finally:
+            if index is not self.dictionary:
+                index.close()
+
+    def search(self, index):
+        """
+        Searches the supplied index (the dictionary, or an open index file)
+        for the word, which can be a pattern, and prints the results.
+        """
+        if self.fuzzy:
+            self.show_similar(index)
+        elif is_query(self.word):
+            self.show_query(index)
+        elif is_pattern(self.word):
+            self.show_matches(index)
+        else:
+            self.show_locations(index)
+
+    def show_locations(self, index):
+        """
+        Looks up the word in the supplied index (the dictionary, or an open
+        index file) and prints the files and line numbers where it was found.
+        """
         try:
             # Retrieve the tuple of all the locations where this word was
             # found, if any. This will raise a KeyError if the word was
             # not found.
-            print "Searching for %s" % self.word.lower()
-            locations = self.dictionary[self.word.lower()]
+            print >> self.output, "Searching for %s" % self.word.lower()
+            locations = index.find(self.word.lower())
             
             # List all the line numbers from each location
-            current_location = ""
-            lines = ""
-            print "Found at:"
-            for location in locations:
-                if current_location != location[0]:
-                    if lines != "":
-                        print "", "", lines
-                        lines = ""
-                    current_location = location[0]
-                    print "", current_location
-                lines += "%d " % location[1]
-            if lines != "":
-                print "", "", lines
+            print >> self.output, "Found at:"
+            self.print_locations(locations)
             
         except KeyError:
-            print "'%s' not found" % self.word
+            print >> self.output, "'%s' not found" % self.word
+
+    def show_matches(self, index):
+        """
+        Looks up all the words in the supplied index (the dictionary, or an
+        open index file) which match the pattern held in the word, and prints
+        each matching word with the files and line numbers where it was
+        found.
+        """
+        pattern = self.word.lower()
+        print >> self.output, "Searching for %s" % pattern
+        found = False
+        for word, locations in index.match(pattern):
+            found = True
+            print >> self.output, "Found %s at:" % word
+            self.print_locations(locations)
+        if not found:
+            print >> self.output, "'%s' not found" % self.word
+
+    def show_similar(self, index):
+        """
+        Looks up the words within the edit distance of the word in the
+        dexter.fuzzy table, and prints each of them, closest first, with the
+        files and line numbers where it was found in the supplied index (the
+        dictionary, or an open index file).
+        """
+        word = self.word.lower()
+        print >> self.output, "Searching for %s (within %d)" % (word, self.distance)
+        with FuzzyFile(os.path.join(self.path, "dexter.fuzzy")) as fuzzy:
+            similar = fuzzy.similar(word, self.distance)
+        for distance, similar_word in similar:
+            print >> self.output, "Found %s at:" % similar_word
+            self.print_locations(index.find(similar_word))
+        if not similar:
+            print >> self.output, "'%s' not found" % self.word
+
+    def show_query(self, index):
+        """
+        Evaluates the query held in the word against the supplied index (the
+        dictionary, or an open index file) and prints the files which satisfy
+        it, with the line numbers where the words of the query were found.
+        """
+        print >> self.output, "Searching for %s" % self.word
+        try:
+            self.load_ignore_words()
+            locations = Query(self.word, self.ignore_words).evaluate(index)
+        except ValueError as error:
+            print >> self.output, error
+            return
+        if locations:
+            print >> self.output, "Found at:"
+            self.print_locations(locations)
+        else:
+            print >> self.output, "'%s' not found" % self.word
+
+    def print_locations(self, locations):
+        """
+        Prints the supplied locations, listing the line numbers under each
+        filename.
+        """
+        current_location = ""
+        lines = ""
+        for location in locations:
+            if current_location != location[0]:
+                if lines != "":
+                    print >> self.output, "", "", lines
+                    lines = ""
+                current_location = location[0]
+                print >> self.output, "", current_location
+            lines += "%d " % location[1]
+        if lines != "":
+            print >> self.output, "", "", lines
+
+    def word_may_exist(self, word):
+        """
+        Returns False if the Bloom filter (dexter.bloom) beside the index, or
+        beside the index of every shard, shows that the word is not in the
+        index, otherwise True.
+        """
+        if self.shards:
+            (depth, folders) = self.read_catalog()
+            paths = [self.path] + [os.path.join(self.path, folder) for folder in folders]
+        else:
+            paths = [self.path]
+        return any(BloomFilter.lookup(path, word) for path in paths)
 
     def list_words(self):
         """
@@ -239,25 +869,277 @@ class Dexter():
         if self.reindex or not self.index_exists():
             self.make_index()
         else:
-            self.read_index()
-            
-        # Temporary version: just list the contents of the dictionary
-        sorted_words = collections.OrderedDict(sorted(self.dictionary.items()))
+            self.dictionary = None
+
+        # Ranking the words only needs the number of locations and files of
+        # each word, which can be read from the index file without loading it
+        if self.by != "word":
+            if self.dictionary is None:
+                with self.open_index() as index:
+                    self.timed("list", self.show_top_words, index)
+            else:
+                self.timed("list", self.show_top_words, self.dictionary)
+            return
+
+        # The index files are sorted by word, so the first words can be read
+        # from the index file without loading it
+        if self.dictionary is None and self.count != -1:
+            with self.open_index() as index:
+                self.timed("list", self.show_words, index)
+            return
+
+        if self.dictionary is None:
+            self.timed("load", self.read_index)
+
+        self.timed("list", self.show_words, self.dictionary)
+
+    def show_top_words(self, index):
+        """
+        Prints the words in the supplied index (the dictionary, or an open
+        index file), with the number of times and the number of files each
+        was found in, ordered by the number of times or the number of files,
+        up to the maximum number of words requested.
+
+        The statistics for the words are read one word at a time, and only
+        the top words are kept, in a heap, so the whole of the vocabulary is
+        never sorted or held in memory.
+        """
+        if self.by == "freq":
+            key = lambda (word, locations, files): (-locations, -files, word)
+        else:
+            key = lambda (word, locations, files): (-files, -locations, word)
+        if self.count == -1:
+            top_words = sorted(index.statistics(), key=key)
+        else:
+            top_words = heapq.nsmallest(self.count, index.statistics(), key=key)
+        for word, locations, files in top_words:
+            print >> self.output, "{:20} {:>10} {:>8}".format(word, locations, files)
+
+    def show_words(self, index):
+        """
+        Prints the words in the supplied index (the dictionary, or an open
+        index file), with their locations, up to the maximum number of words
+        requested.
+        """
+        # The words of an index file are already in order, and only the words
+        # of the dictionary which will be listed need sorting
+        if not isinstance(index, Postings):
+            sorted_words = list(itertools.islice(index.words(), None if self.count == -1 else self.count))
+        elif self.count == -1:
+            sorted_words = sorted(index)
+        else:
+            sorted_words = heapq.nsmallest(self.count, index)
         count = 0
         if self.count == -1:
             self.count = len(sorted_words)
 
-        for word, locations in sorted_words.iteritems():
+        for word in sorted_words:
             count += 1
             if count <= self.count:
                 if self.abbreviate:
-                    print "%s %s" % (word.strip(), self.book_index_entry(locations))
+                    print >> self.output, "%s %s" % (word.strip(), self.book_index_entry(index.find(word)))
                 else:
-                    for location in locations:
-                        print "{:20}|{:06d}|{}".format(word, location[1], location[0])
+                    for location in index.find(word):
+                        print >> self.output, "{:20}|{:06d}|{}".format(word, location[1], location[0])
             else:
                 break        
 
+    def serve(self):
+        """
+        Loads the index of the directory, building it first if necessary,
+        and then answers requests from clients over a Unix socket until it
+        is interrupted.
+
+        Each request is a single line, either "find <word>" or "list <count>
+        <abbreviate> [<order>]", where a count of -1 lists all the words,
+        abbreviate is 1 or 0, and the order is one of LIST_ORDERS (word, by
+        default). The reply is the same output as the 'find' or 'list'
+        command gives, followed by a line holding a single '.'. A client can
+        send any number of requests over one connection.
+
+        The index is reloaded whenever the index file changes.
+        """
+        if self.reindex or not self.index_exists():
+            self.make_index()
+        else:
+            self.dictionary = None
+        if self.dictionary is None:
+            self.timed("load", self.read_index)
+        loaded = os.stat(self.index_filespec()).st_mtime
+
+        import socket
+        filespec = self.socket_filespec()
+        if os.path.exists(filespec):
+            os.remove(filespec)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(filespec)
+        server.listen(16)
+        self.report("Serving %s on %s" % (self.path, filespec))
+
+        # Treat a termination signal as an interruption, so that the socket
+        # file is still removed
+        signal.signal(signal.SIGTERM, lambda number, frame: sys.exit(0))
+        try:
+            while True:
+                (connection, address) = server.accept()
+                modified = self.index_mtime()
+                if modified is not None and modified != loaded:
+                    self.report("Reloading index for %s" % self.path)
+                    previous = self.dictionary
+                    try:
+                        self.read_index()
+                        loaded = modified
+                    except (IOError, OSError) as e:
+                        self.report("Unable to reload index: %s" % e)
+                        self.dictionary = previous
+                try:
+                    self.answer_requests(connection)
+                except socket.error as e:
+                    self.report("Connection failed: %s" % e)
+                finally:
+                    connection.close()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            server.close()
+            os.remove(filespec)
+
+    def answer_requests(self, connection):
+        """
+        Reads requests from the supplied client connection and writes the
+        replies to them, until the client closes the connection. A request
+        which is not valid gets an error message as its reply, rather than
+        stopping the server.
+        """
+        stream = connection.makefile("rw")
+        self.output = stream
+        try:
+            for request in stream:
+                request = request.split()
+                if len(request) >= 2 and request[0] == "find":
+                    self.word = " ".join(request[1:])
+                    self.search(self.dictionary)
+                elif (len(request) in (3, 4) and request[0] == "list" and re.match(r"-?\d+$", request[1]) and
+                        request[2] in ("0", "1") and (len(request) == 3 or request[3] in LIST_ORDERS)):
+                    self.count = int(request[1])
+                    self.abbreviate = (request[2] == "1")
+                    self.by = request[3] if len(request) == 4 else "word"
+                    if self.by == "word":
+                        self.show_words(self.dictionary)
+                    else:
+                        self.show_top_words(self.dictionary)
+                else:
+                    print >> stream, "Invalid request: %s" % " ".join(request)
+                print >> stream, "."
+                stream.flush()
+        finally:
+            self.output = sys.stdout
+            stream.close()
+
+    def watch(self):
+        """
+        Builds or updates the index of the directory, and then watches the
+        directory for changes, keeping the index up to date, until it is
+        interrupted.
+
+        The dictionary is kept in memory, and only the files which change are
+        rescanned. The index is rewritten once there have been no further
+        changes for the --interval, or once changes have been waiting for
+        WATCH_MAX_DELAY intervals, so that a burst of changes only rewrites
+        it once. A sharded index is updated with make_index() instead, which
+        only rewrites the shards which have changed.
+
+        Changes are reported by inotify where it can be used, otherwise the
+        directory is checked for changes every interval.
+        """
+        self.make_index()
+        if not self.shards and self.dictionary is None:
+            self.timed("load", self.read_index)
+        self.sniff_cache = self.sniffed
+        watcher = self.open_watcher()
+        self.report("Watching %s" % self.path)
+
+        # Treat a termination signal as an interruption, so that any changes
+        # which are waiting are still saved
+        signal.signal(signal.SIGTERM, lambda number, frame: sys.exit(0))
+        pending = set()
+        waiting = None
+        try:
+            while True:
+                changes = watcher.changes(self.interval)
+                if changes:
+                    pending.update(changes)
+                    if waiting is None:
+                        waiting = time.time()
+                    if time.time() - waiting < self.interval * WATCH_MAX_DELAY:
+                        continue
+                if pending:
+                    self.update_index(pending)
+                    pending = set()
+                    waiting = None
+        except (KeyboardInterrupt, SystemExit):
+            if pending:
+                self.update_index(pending)
+        finally:
+            watcher.close()
+
+    def open_watcher(self):
+        """
+        Returns an InotifyWatcher for the path, or a PollingWatcher if inotify
+        cannot be used.
+        """
+        try:
+            return InotifyWatcher(self.path, self.recurse, self.list_folder)
+        except OSError as e:
+            self.report("Checking for changes every %g seconds, as inotify cannot be used: %s" % (self.interval, e))
+            return PollingWatcher(lambda: self.walk_files(self.path))
+
+    def update_index(self, filespecs):
+        """
+        Updates the index for the supplied files and folders, which have
+        changed, and rewrites it if anything in it has changed.
+        """
+        if self.shards:
+            self.make_index()
+            return
+        self.report("Updating index for %s" % self.path)
+        self.update_files(filespecs)
+        if self.changed:
+            self.timed("save", self.save_index)
+            if self.fuzzy_exists():
+                self.timed("save", self.save_fuzzy)
+            self.save_manifest()
+            self.save_sniff_cache()
+
+    def send_request(self):
+        """
+        Sends the 'find' or 'list' request to the server for the directory,
+        and prints the reply.
+        """
+        if self.params["find"]:
+            request = "find %s\n" % self.word
+        else:
+            request = "list %d %d %s\n" % (self.count, 1 if self.abbreviate else 0, self.by)
+
+        import socket
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.socket_filespec())
+        except socket.error:
+            print "No server running for %s" % self.path
+            return
+        try:
+            stream = client.makefile("rw")
+            stream.write(request)
+            stream.flush()
+            for line in stream:
+                if line == ".\n":
+                    break
+                self.output.write(line)
+            stream.close()
+        finally:
+            client.close()
+
     def book_index_entry(self, locations):
         """
         Scans the supplied list of filenames and numbers and builds a book-style
@@ -296,130 +1178,855 @@ class Dexter():
     def scan_file(self, filespec):
         """
         Scans the specified file, extracting all the words it can find,
-        and returning a list of them.
+        and adding them to the dictionary. The whole of the file is read and
+        scanned in one go (see scan_text), which is much faster than handling
+        it a line at a time, and the phases are timed on this same path when
+        --stats is given. Large files are scanned in chunks (see
+        scan_large_file).
         """
-        words = []
-
         self.report("Scanning %s" % filespec)
-
+        self.load_ignore_words()
+        if os.path.getsize(filespec) >= LARGE_FILE_SIZE:
+            self.scan_large_file(filespec)
+            return
         with open(filespec, 'r') as f:
-            line_number = 1
-            for line in f:
-                words = self.scan_line(line)
-                for word in words:
-                    if len(word) > 2:
-                        if word not in self.ignore_words:
-                            self.add_to_dictionary(word, filespec, line_number)
-                        elif self.verbose:
-                            print "Ignoring %s" % word
-                line_number += 1
+            text = self.timed("read", f.read)
+        if self.stats:
+            self.stats.count("files")
+            self.stats.count("bytes", len(text))
+        self.scan_text(filespec, text)
+
+    def scan_large_file(self, filespec):
+        """
+        Scans the specified file in the same way as scan_file, but through a
+        memory map of the file, SCAN_CHUNK_SIZE bytes at a time, so that only
+        one chunk of it is held in memory at once. Each chunk is extended to
+        the end of the line it finishes in, and is scanned in one go (see
+        scan_text), which avoids the cost of handling the file a line at a
+        time.
+
+        The memory budget is checked after each chunk, so that one very large
+        file cannot grow the dictionary without limit. The runs are merged in
+        the order they were written, so the locations of a file which is
+        split across runs stay in order.
+        """
+        stats = self.stats
+        line_number = 1
+        with open(filespec, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if stats:
+                stats.count("files")
+                stats.count("bytes", len(data))
+            start = 0
+            while start < len(data):
+                end = data.find("\n", min(start + SCAN_CHUNK_SIZE, len(data)) - 1)
+                if end < 0:
+                    end = len(data)
+                else:
+                    end += 1
+                chunk = self.timed("read", data.__getitem__, slice(start, end))
+                line_number = self.scan_text(filespec, chunk, line_number)
+                self.check_memory()
+                start = end
+        finally:
+            data.close()
+
+    def scan_text(self, filespec, text, line_number=1):
+        """
+        Adds the words in the supplied text, which has been read from the
+        specified file, starting at the specified line, to the dictionary.
+        The text is tokenized in one go into a single list of words and
+        newlines (see Tokenizer.tokens), from which the line numbers are
+        counted. Returns the number of the line following the text.
+        """
+        tokens = self.timed("tokenize", self.tokenizer.tokens, text)
+        if self.verbose:
+            for word in tokens:
+                if word in self.ignore_words:
+                    print "Ignoring %s" % word
+        (next_line, ignored) = self.timed("insert", self.dictionary.add_tokens, filespec, tokens,
+            self.ignore_words, line_number)
+        if self.stats:
+            self.stats.count("tokens", len(tokens) - (next_line - line_number))
+            self.stats.count("ignored", ignored)
+        return next_line
 
     def scan_line(self, line):
         """
         Scans the supplied line for words, returning a list of all the
-        words found.
-        """
-        words = []
-        word = ""
-        alpha = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
-        for char in line:
-            if char in alpha:
-                word += char
-            else:
-                if word.strip() != "":
-                    words.append(word.strip().lower())
-                word = ""
+        words found, in lower-case. Words shorter than three letters are
+        skipped.
+        """
+        return self.tokenizer.words(line)
 
-        return words
+    def check_memory(self):
+        """
+        If a memory budget has been set and the dictionary has grown beyond
+        it, writes the dictionary out to a new run file and starts a new,
+        empty dictionary.
+        """
+        if self.memory and self.dictionary.size > self.memory:
+            self.flush_run()
+
+    def flush_run(self):
+        """
+        Writes the dictionary to a temporary 'run' file in the target path,
+        sorted by word in the same format as the dexter.index file, and
+        starts a new, empty dictionary.
+        """
+        import tempfile
+        (handle, filespec) = tempfile.mkstemp(prefix=RUN_PREFIX, suffix=RUN_SUFFIX, dir=self.path)
+        self.report("Writing %d words to %s" % (len(self.dictionary), filespec))
+        self.runs.append(filespec)
+        with os.fdopen(handle, "wb") as f:
+            self.write_text_index(f, self.dictionary)
+        self.dictionary = Postings(self.positions)
 
-    def add_to_dictionary(self, word, filespec, line_number):
+    def add_to_dictionary(self, word, filespec, line_number, position=0):
         """
         Adds the supplied word to the dictionary, or updates an existing
-        word with the additional details.
+        word with the additional details. The position of the word within
+        the line is only kept if the index has positions.
         """
-        if not word in self.dictionary:
-            self.dictionary[word] = [(filespec, line_number)]
-        else:
-            self.dictionary[word].append((filespec, line_number))
+        self.dictionary.add(word, filespec, line_number, position)
+
+    def remove_files(self, filespecs):
+        """
+        Removes all the entries for the supplied files from the dictionary,
+        dropping any words which no longer have any locations.
+        """
+        self.dictionary.remove_files(filespecs)
+
+    def load_ignore_words(self):
+        """
+        Reads the 'ignore' words (see read_ignore_file), unless they have
+        already been read. They are only needed for scanning files and for
+        queries, so looking a word up in an existing index never reads them.
+        """
+        if self.ignore_words is None:
+            self.read_ignore_file()
 
     def read_ignore_file(self):
         """
-        Reads the list of 'ignore' words from file.
+        Reads the list of 'ignore' words from file, and stores them as a set
+        so that each word can be checked against them with a single lookup.
+
+        The set is cached in compiled form in a '.cache' file beside the
+        ignore file, which is used instead of the ignore file for as long as
+        the size and modification time of the ignore file are unchanged.
         """
         if self.ignore_file:
             filespec = self.ignore_file
         else:
             filespec = os.path.join(os.path.expanduser("~"), ".dexter", "dexter.ignore")
         if os.path.exists(filespec):
-            with open(filespec, "r") as f:
-                self.ignore_words = f.read().splitlines()
+            status = os.stat(filespec)
+            signature = (IGNORE_CACHE_VERSION, status.st_size, status.st_mtime)
+            self.ignore_words = self.read_ignore_cache(filespec + ".cache", signature)
+            if self.ignore_words is None:
+                with open(filespec, "r") as f:
+                    self.ignore_words = frozenset(word.strip().lower() for word in f.read().splitlines() if word.strip())
+                self.write_ignore_cache(filespec + ".cache", signature)
         else:
-            report("Ignore file not found, using default")
+            self.report("Ignore file not found, using default")
+            self.ignore_words = frozenset(DEFAULT_IGNORE_WORDS)
             self.write_ignore_file()
 
+    def read_ignore_cache(self, filespec, signature):
+        """
+        Returns the set of 'ignore' words from the specified cache file, or
+        None if there is no cache file, or if it was created from a different
+        version of the ignore file.
+        """
+        try:
+            with open(filespec, "rb") as f:
+                (cache_signature, words) = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if cache_signature != signature:
+            return None
+        return words
+
+    def write_ignore_cache(self, filespec, signature):
+        """
+        Writes the set of 'ignore' words to the specified cache file. Failing
+        to write the cache is not an error, as the words will simply be read
+        from the ignore file again next time.
+        """
+        try:
+            with open(filespec, "wb") as f:
+                marshal.dump((signature, self.ignore_words), f)
+        except (IOError, OSError):
+            self.report("Unable to write %s" % filespec)
+
     def write_ignore_file(self):
         """
-        Writes the current list of 'ignore' files as the default list
+        Writes the default list of 'ignore' words as the default ignore file,
+        so that it can be edited. Failing to write it is not an error, as the
+        default list is simply used again next time.
         """
         filespec = os.path.join(os.path.expanduser("~"), ".dexter")
-        if not os.path.exists(filespec):
-            os.makedirs(filespec)
-        with open(os.path.join(filespec, "dexter.ignore"), "w") as f:
-            for word in self.ignore_words:
-                f.write("%s\n" % word)
+        try:
+            if not os.path.exists(filespec):
+                os.makedirs(filespec)
+            with open(os.path.join(filespec, "dexter.ignore"), "w") as f:
+                for word in DEFAULT_IGNORE_WORDS:
+                    f.write("%s\n" % word)
+        except (IOError, OSError):
+            self.report("Unable to write %s" % filespec)
             
     def read_index(self):
         """
         Reads the dexter.index file and imports the contents. Assumes that the
-        file has already been confirmed to exist.
+        file has already been confirmed to exist. If the index is sharded,
+        the indexes of all the shards are read.
         """
-        self.dictionary = {}
-        with open(os.path.join(self.path, "dexter.index"), "r") as f:
+        if self.shards:
+            with self.open_index() as index:
+                self.dictionary = index.load()
+            return
+        if self.format == "binary":
+            with BinaryIndex(os.path.join(self.path, "dexter.bindex")) as index:
+                self.dictionary = index.load()
+            return
+        self.dictionary = Postings(self.index_has_positions())
+        with open(os.path.join(self.path, "dexter.index"), "rb") as f:
             for line in f:
-                line = line.strip()
-                (word, line_number, filespec) = line.split("|")
-                self.add_to_dictionary(word.strip(), filespec, int(line_number))
+                (word, location) = parse_record(line)
+                self.add_to_dictionary(word, *location)
                 
     def save_index(self):
         """
         Saves the dexter.index file into the path given on the command-line,
         or to the current working directory by default.
+
+        If the dictionary has been written out in runs, or the existing index
+        is to be merged with the new words, the runs are merged into the
+        index instead.
         """
-        sorted_words = collections.OrderedDict(sorted(self.dictionary.items()))
-        with open(os.path.join(self.path, "dexter.index"), "w") as f:
-            for word, locations in sorted_words.iteritems():
-                for location in locations:
-                    f.write("{:20}|{:06d}|{}\n".format(word, location[1], location[0]))
-    
-    # ----------------------------------------------------------------------
-    # Support functions
-    # ----------------------------------------------------------------------
-    
-    def verify_path(self):
+        if self.runs or self.merge_existing:
+            self.merge_runs()
+            return
+        # Each file is written under a temporary name and then renamed over
+        # the old one, so that the index can be searched while it is saved
+        if self.format == "binary":
+            filespec = os.path.join(self.path, "dexter.bindex")
+            BinaryIndex.write(filespec + TEMP_SUFFIX, self.dictionary, self.compress)
+            replace_file(filespec + TEMP_SUFFIX, filespec)
+            self.remove_index("text")
+        else:
+            filespec = os.path.join(self.path, "dexter.index")
+            with open(filespec + TEMP_SUFFIX, "wb") as f:
+                self.write_text_index(f, self.dictionary)
+            replace_file(filespec + TEMP_SUFFIX, filespec)
+            self.save_suffixes(self.dictionary)
+            self.remove_index("binary")
+        self.save_bloom(self.dictionary)
+
+    def save_bloom(self, words):
         """
-        If no path is supplied, the current working directory is
-        used instead.
-        
-        Checks that the path is valid. If it is not, an error message is
-        printed, and the function returns False, otherwise it returns True.
+        Saves the dexter.bloom file alongside the index file, holding a Bloom
+        filter of the supplied words (see BloomFilter). This must be done
+        once the index file has been written, as the filter records the size
+        and modification time of the index file it belongs to.
         """
-        if not self.path:
-            self.path = os.getcwd()
+        BloomFilter.write(self.path, words, self.format == "binary")
 
-        if not os.path.exists(self.path):
-            print "Path not found: %s" % self.path
-            return False
-        else:
-            return True
+    def save_fuzzy(self):
+        """
+        Saves the dexter.fuzzy file alongside the index file, reading the
+        words from the index. For each word this holds a record of each of
+        the strings made by deleting up to FUZZY_DISTANCE letters from it,
+        sorted by the deletion, so that the words within a given edit distance
+        of a word can be found by looking up the deletions of that word rather
+        than by comparing it with every word (see FuzzyFile).
 
-    def index_exists(self):
+        If the file already exists, only the records of the words which have
+        been added to or removed from the index are changed: the records of
+        the new words are merged with the existing records, less those of the
+        removed words. The file is left alone if the words are unchanged.
         """
-        Returns True if an index file (dexter.index) exists in the
+        filespec = os.path.join(self.path, "dexter.fuzzy")
+        with self.open_index() as index:
+            words = set(index.words())
+        if self.fuzzy_exists():
+            with open(filespec, "rb") as f:
+                old_words = set(read_fuzzy_words(f))
+            if old_words == words:
+                return
+            existing = open(filespec, "rb")
+        else:
+            old_words = set()
+            existing = None
+        added = words - old_words
+        removed = old_words - words
+        self.report("Updating %s: %d words added, %d removed" % (filespec, len(added), len(removed)))
+
+        records = ((deletion, word) for word in added for deletion in deletions(word, FUZZY_DISTANCE))
+        try:
+            sources = [sort_records(records, self.path)]
+            if existing:
+                sources.append(read_fuzzy_records(existing, removed))
+            with open(filespec + TEMP_SUFFIX, "wb") as f:
+                for deletion, word in heapq.merge(*sources):
+                    f.write("%s|%s\n" % (deletion, word))
+        finally:
+            if existing:
+                existing.close()
+        replace_file(filespec + TEMP_SUFFIX, filespec)
+
+    def save_suffixes(self, words):
+        """
+        Saves the dexter.suffixes file alongside the dexter.index file. This
+        holds each of the supplied words reversed, sorted, one per line, so
+        that words with a given ending can be found by binary search.
+        """
+        filespec = os.path.join(self.path, "dexter.suffixes")
+        with open(filespec + TEMP_SUFFIX, "wb") as f:
+            for word in sorted(word[::-1] for word in words):
+                f.write("%s\n" % word)
+        replace_file(filespec + TEMP_SUFFIX, filespec)
+
+    def write_text_index(self, f, dictionary):
+        """
+        Writes the supplied dictionary to the supplied file, sorted by word,
+        in the format of the dexter.index file.
+        """
+        for word in sorted(dictionary):
+            for location in dictionary.locations(word):
+                f.write(format_record(word, location))
+
+    def merge_runs(self):
+        """
+        Merges the run files, the remaining contents of the dictionary and,
+        when updating an existing index, the existing index (less the entries
+        for stale files) into a new index file, and deletes the runs.
+
+        Each source is read one word at a time, in word order, so only the
+        locations of the word currently being merged are held in memory.
+        """
+        if len(self.dictionary):
+            self.flush_run()
+        self.dictionary = None
+
+        sources = []
+        if self.merge_existing:
+            if self.format == "binary":
+                existing = BinaryIndex(os.path.join(self.path, "dexter.bindex"))
+                sources.append(existing.groups(len(sources), self.stale))
+            else:
+                existing = open(os.path.join(self.path, "dexter.index"), "rb")
+                sources.append(read_text_groups(existing, len(sources), self.stale))
+        else:
+            existing = None
+        run_files = [open(filespec, "rb") for filespec in self.runs]
+        for f in run_files:
+            sources.append(read_text_groups(f, len(sources)))
+
+        # Merge the sources into a temporary file, as the existing index is
+        # still being read from, then replace the index with it
+        if self.format == "binary":
+            filespec = os.path.join(self.path, "dexter.bindex")
+        else:
+            filespec = os.path.join(self.path, "dexter.index")
+        try:
+            self.report("Merging %d runs into %s" % (len(sources), filespec))
+            merged = merge_groups(heapq.merge(*sources))
+            if self.format == "binary":
+                BinaryIndex.write_groups(filespec + TEMP_SUFFIX, merged, self.positions, self.compress)
+            else:
+                words = []
+                with open(filespec + TEMP_SUFFIX, "wb") as f:
+                    for word, locations in merged:
+                        words.append(word)
+                        for location in locations:
+                            f.write(format_record(word, location))
+        finally:
+            if existing:
+                existing.close()
+            for f in run_files:
+                f.close()
+            for run in self.runs:
+                os.remove(run)
+            self.runs = []
+        replace_file(filespec + TEMP_SUFFIX, filespec)
+        if self.format == "binary":
+            self.remove_index("text")
+            with BinaryIndex(filespec) as index:
+                words = list(index.words())
+        else:
+            self.save_suffixes(words)
+            self.remove_index("binary")
+        self.save_bloom(words)
+
+    def read_manifest(self):
+        """
+        Reads the dexter.manifest file, which records the size, modification
+        time and inode of each file in the index. Assumes that the file has
+        already been confirmed to exist.
+        """
+        self.manifest = {}
+        with open(os.path.join(self.path, "dexter.manifest"), "rb") as f:
+            for number, line in enumerate(f):
+                if number == 0 and line.startswith("ignore|"):
+                    continue
+                (size, mtime, inode, filespec) = line.rstrip("\n").split("|", 3)
+                self.manifest[filespec] = (int(size), float(mtime), int(inode))
+
+    def read_manifest_ignore(self):
+        """
+        Returns the signature of the 'ignore' words which the index was built
+        with, from the first line of the dexter.manifest file, or None if the
+        manifest does not record it.
+        """
+        with open(os.path.join(self.path, "dexter.manifest"), "rb") as f:
+            line = f.readline().rstrip("\n")
+        if line.startswith("ignore|"):
+            return line.split("|", 1)[1]
+        return None
+
+    def ignore_signature(self):
+        """
+        Returns a signature of the set of 'ignore' words (an MD5 digest of the
+        sorted words), which changes whenever the set does.
+        """
+        self.load_ignore_words()
+        return hashlib.md5("\n".join(sorted(self.ignore_words))).hexdigest()
+
+    def save_manifest(self):
+        """
+        Saves the dexter.manifest file alongside the dexter.index file. The
+        first line records the signature of the 'ignore' words, so that the
+        index is rebuilt if they change.
+        """
+        with open(os.path.join(self.path, "dexter.manifest"), "wb") as f:
+            f.write("ignore|%s\n" % self.ignore_signature())
+            for filespec, (size, mtime, inode) in self.manifest.iteritems():
+                f.write("%d|%r|%d|%s\n" % (size, mtime, inode, filespec))
+    
+    def read_sniff_cache(self):
+        """
+        Reads the dexter.sniff file, which records whether each file which
+        has been examined was found to be a text file, against the inode and
+        modification time of the file. Assumes that the file has already been
+        confirmed to exist.
+        """
+        self.sniff_cache = {}
+        with open(os.path.join(self.path, "dexter.sniff"), "rb") as f:
+            for line in f:
+                (inode, mtime, result) = line.rstrip("\n").split("|")
+                self.sniff_cache[(int(inode), float(mtime))] = (result == "1")
+
+    def save_sniff_cache(self):
+        """
+        Saves the dexter.sniff file alongside the dexter.index file, holding
+        the results for the files found while building the index.
+        """
+        with open(os.path.join(self.path, "dexter.sniff"), "wb") as f:
+            for (inode, mtime), result in self.sniffed.iteritems():
+                f.write("%d|%r|%d\n" % (inode, mtime, 1 if result else 0))
+
+    def read_catalog(self):
+        """
+        Reads the dexter.shards catalog, returning the shard depth and the
+        list of the shard folders, relative to the path. Assumes that the
+        file has already been confirmed to exist.
+        """
+        with open(os.path.join(self.path, "dexter.shards"), "rb") as f:
+            lines = f.read().splitlines()
+        return (int(lines[0]), lines[1:])
+
+    def save_catalog(self, folders):
+        """
+        Saves the dexter.shards catalog, recording the shard depth and the
+        supplied list of shard folders.
+        """
+        with open(os.path.join(self.path, "dexter.shards"), "wb") as f:
+            f.write("%d\n" % self.shards)
+            for folder in folders:
+                f.write("%s\n" % folder)
+
+    # ----------------------------------------------------------------------
+    # Support functions
+    # ----------------------------------------------------------------------
+    
+    def verify_path(self):
+        """
+        If no path is supplied, the current working directory is
+        used instead.
+        
+        Checks that the path is valid. If it is not, an error message is
+        printed, and the function returns False, otherwise it returns True.
+        """
+        if not self.path:
+            self.path = os.getcwd()
+
+        if not os.path.exists(self.path):
+            print "Path not found: %s" % self.path
+            return False
+        else:
+            return True
+
+    def verify_shards(self):
+        """
+        If no shard depth is supplied, the depth in the existing catalog is
+        used, if there is one. Sharding implies the --recurse option.
+
+        Checks that the depth is a number, zero meaning no sharding. If it is
+        not, an error message is printed, and the function returns False,
+        otherwise it returns True.
+        """
+        if self.shards is None:
+            if self.catalog_exists():
+                self.shards = self.read_catalog()[0]
+        else:
+            try:
+                self.shards = int(self.shards)
+            except ValueError:
+                self.shards = -1
+            if self.shards < 0:
+                print "Invalid shard depth: %s" % self.params["--shards"]
+                return False
+        if self.shards:
+            self.recurse = True
+        return True
+
+    def verify_format(self):
+        """
+        If no index format is supplied, the format of the existing index is
+        used, or the text format if there is no index yet.
+
+        The compressed format is the binary format with compressed postings,
+        so it is recorded as the binary format with the compress flag set. If
+        the format is taken from an existing binary index, the compress flag
+        is left as None, to be read from the index by read_index_options().
+
+        Checks that the format is valid. If it is not, an error message is
+        printed, and the function returns False, otherwise it returns True.
+        """
+        if self.format == "compressed":
+            self.format = "binary"
+            self.compress = True
+        elif not self.format:
+            if os.path.exists(os.path.join(self.path, "dexter.bindex")):
+                self.format = "binary"
+                self.compress = None
+            else:
+                self.format = "text"
+
+        if self.format not in ("text", "binary"):
+            print "Unknown index format: %s" % self.format
+            return False
+        else:
+            return True
+
+    def read_index_options(self):
+        """
+        Fills in the options which default to those of the existing index. If
+        the --positions option is not supplied, positions are recorded if the
+        existing index has them, unless the index is being rebuilt with the
+        --full option, and a binary index is compressed if the existing one
+        is.
+
+        This opens the index, so it is done when the index is about to be
+        built rather than in setup(), so that a 'find' which the Bloom filter
+        rules out does not open the index at all.
+        """
+        if not self.positions:
+            self.positions = not self.full and self.index_has_positions()
+        if self.compress is None:
+            with self.open_index_file() as index:
+                self.compress = index.compressed
+
+    def verify_distance(self):
+        """
+        Checks that the edit distance for 'find --fuzzy' is a number from 1
+        up to the largest distance in the dexter.fuzzy table. If it is not,
+        an error message is printed, and the function returns False,
+        otherwise it returns True.
+        """
+        try:
+            self.distance = int(self.distance or 1)
+        except ValueError:
+            self.distance = 0
+        if not 1 <= self.distance <= FUZZY_DISTANCE:
+            print "Invalid edit distance: %s (must be from 1 to %d)" % (self.params["--distance"], FUZZY_DISTANCE)
+            return False
+        else:
+            return True
+
+    def verify_by(self):
+        """
+        Checks that the order for 'list' is valid. If it is not, an error
+        message is printed, and the function returns False, otherwise it
+        returns True.
+        """
+        if self.by not in LIST_ORDERS:
+            print "Unknown order: %s" % self.by
+            return False
+        else:
+            return True
+
+    def verify_max_size(self):
+        """
+        Checks that the maximum file size, if one has been given, is a
+        positive number of megabytes, and converts it to bytes. If it is not
+        valid, an error message is printed, and the function returns False,
+        otherwise it returns True.
+        """
+        if not self.max_size:
+            return True
+        try:
+            megabytes = float(self.max_size)
+        except ValueError:
+            megabytes = 0
+        if megabytes <= 0:
+            print "Invalid maximum file size: %s" % self.max_size
+            return False
+        else:
+            self.max_size = int(megabytes * 1048576)
+            return True
+
+    def verify_jobs(self):
+        """
+        Checks that the number of processes is a positive number. If it is
+        not, an error message is printed, and the function returns False,
+        otherwise it returns True.
+        """
+        try:
+            self.jobs = int(self.jobs or 1)
+        except ValueError:
+            self.jobs = 0
+        if self.jobs < 1:
+            print "Invalid number of jobs: %s" % self.params["--jobs"]
+            return False
+        else:
+            return True
+
+    def verify_readers(self):
+        """
+        Checks that the number of reader threads, if one has been given, is a
+        positive number. If it is not, an error message is printed, and the
+        function returns False, otherwise it returns True.
+        """
+        try:
+            self.readers = int(self.readers or 0)
+        except ValueError:
+            self.readers = -1
+        if self.readers < 0:
+            print "Invalid number of readers: %s" % self.params["--readers"]
+            return False
+        else:
+            return True
+
+    def verify_memory(self):
+        """
+        Checks that the memory budget, if one has been given, is a positive
+        number of megabytes, and converts it to bytes. If it is not valid, an
+        error message is printed, and the function returns False, otherwise
+        it returns True.
+        """
+        if not self.memory:
+            return True
+        try:
+            megabytes = float(self.memory)
+        except ValueError:
+            megabytes = 0
+        if megabytes <= 0:
+            print "Invalid memory budget: %s" % self.memory
+            return False
+        else:
+            self.memory = int(megabytes * 1048576)
+            return True
+
+    def verify_interval(self):
+        """
+        Checks that the interval for 'watch' is a positive number of seconds.
+        If it is not, an error message is printed, and the function returns
+        False, otherwise it returns True.
+        """
+        try:
+            self.interval = float(self.interval or 2)
+        except ValueError:
+            self.interval = 0
+        if self.interval <= 0:
+            print "Invalid interval: %s" % self.params["--interval"]
+            return False
+        else:
+            return True
+
+    def index_exists(self):
+        """
+        Returns True if an index file (dexter.index, or dexter.bindex for the
+        binary format) exists in the specified path.
+        """
+        if self.format == "binary":
+            filespec = os.path.join(self.path, "dexter.bindex")
+        else:
+            filespec = os.path.join(self.path, "dexter.index")
+        return os.path.exists(filespec)
+
+    def index_mtime(self):
+        """
+        Returns the modification time of the index file, or None if there is
+        no index file. If the index has been rebuilt in the other format, the
+        format is switched to follow it.
+        """
+        if not self.shards:
+            if os.path.exists(os.path.join(self.path, "dexter.bindex")):
+                self.format = "binary"
+            elif os.path.exists(os.path.join(self.path, "dexter.index")):
+                self.format = "text"
+        try:
+            return os.stat(self.index_filespec()).st_mtime
+        except OSError:
+            return None
+
+    def index_has_positions(self):
+        """
+        Returns True if an index file exists and records the position of each
+        word within its line. The index is probed in whichever format it was
+        written, rather than the current format, so that changing the format
+        keeps the positions of the existing index.
+        """
+        filespec = os.path.join(self.path, "dexter.bindex")
+        if os.path.exists(filespec):
+            index = BinaryIndex(filespec)
+        else:
+            filespec = os.path.join(self.path, "dexter.index")
+            if not os.path.exists(filespec):
+                return False
+            index = TextIndex(filespec)
+        with index:
+            return index.positions
+
+    def index_filespec(self):
+        """
+        Returns the filespec of the index file, for the current format, or of
+        the catalog if the index is sharded.
+        """
+        if self.shards:
+            return os.path.join(self.path, "dexter.shards")
+        if self.format == "binary":
+            return os.path.join(self.path, "dexter.bindex")
+        else:
+            return os.path.join(self.path, "dexter.index")
+
+    def socket_filespec(self):
+        """
+        Returns the filespec of the socket used by the 'serve' and 'client'
+        commands, which defaults to dexter.sock in the path.
+        """
+        if self.socket:
+            return self.socket
+        return os.path.join(self.path, "dexter.sock")
+
+    def open_index(self):
+        """
+        Opens the index for searching, returning a ShardedIndex if the index
+        is sharded, otherwise the index file (see open_index_file).
+
+        A shard in the catalog which has no index (because its folder has
+        been removed since the index was built) is left out, with a warning
+        that the catalog is out of date.
+        """
+        if self.shards:
+            (depth, folders) = self.read_catalog()
+            paths = [self.path]
+            for folder in folders:
+                path = os.path.join(self.path, folder)
+                if ShardedIndex.shard_exists(path):
+                    paths.append(path)
+                else:
+                    print >> sys.stderr, "No index for shard %s: run 'index' to update %s" % (
+                        path, os.path.join(self.path, "dexter.shards"))
+            return ShardedIndex(paths, self.jobs)
+        return self.open_index_file()
+
+    def open_index_file(self):
+        """
+        Opens the index file in the path for searching, returning a
+        BinaryIndex or a TextIndex depending on the format of the index.
+        Assumes that the file has already been confirmed to exist.
+        """
+        if self.format == "binary":
+            return BinaryIndex(os.path.join(self.path, "dexter.bindex"))
+        else:
+            return TextIndex(os.path.join(self.path, "dexter.index"))
+
+    def remove_index(self, format):
+        """
+        Deletes the index file of the specified format, if there is one, so
+        that an index in the other format cannot be left behind out of date.
+        """
+        if format == "binary":
+            filespecs = [os.path.join(self.path, "dexter.bindex")]
+        else:
+            filespecs = [os.path.join(self.path, "dexter.index"), os.path.join(self.path, "dexter.suffixes")]
+        for filespec in filespecs:
+            if os.path.exists(filespec):
+                os.remove(filespec)
+
+    def fuzzy_exists(self):
+        """
+        Returns True if the table of misspellings used by 'find --fuzzy'
+        (dexter.fuzzy) exists in the specified path.
+        """
+        filespec = os.path.join(self.path, "dexter.fuzzy")
+        return os.path.exists(filespec)
+
+    def catalog_exists(self):
+        """
+        Returns True if a catalog of shards (dexter.shards) exists in the
+        specified path.
+        """
+        filespec = os.path.join(self.path, "dexter.shards")
+        return os.path.exists(filespec)
+
+    def sniff_cache_exists(self):
+        """
+        Returns True if a cache of the results of examining files (dexter.sniff)
+        exists in the specified path.
+        """
+        filespec = os.path.join(self.path, "dexter.sniff")
+        return os.path.exists(filespec)
+
+    def manifest_exists(self):
+        """
+        Returns True if a manifest file (dexter.manifest) exists in the
         specified path.
         """
-        filespec = os.path.join(self.path, "dexter.index")
+        filespec = os.path.join(self.path, "dexter.manifest")
         return os.path.exists(filespec)
+
+    def file_signature(self, filespec):
+        """
+        Returns a (size, mtime, inode) tuple for the specified file, used to
+        detect files which have changed since the last time they were indexed.
+
+        Raises OSError if the file is not a regular file (such as a FIFO or a
+        device), as reading it could block forever.
+        """
+        status = os.stat(filespec)
+        if not stat.S_ISREG(status.st_mode):
+            raise OSError(errno.EINVAL, "Not a regular file", filespec)
+        return (status.st_size, status.st_mtime, status.st_ino)
     
+    def timed(self, phase, function, *args):
+        """
+        Calls the supplied function with the supplied arguments, returning
+        its result. If the --stats option has been specified, the time taken
+        is added to the specified phase.
+        """
+        if not self.stats:
+            return function(*args)
+        self.stats.start(phase)
+        try:
+            return function(*args)
+        finally:
+            self.stats.stop(phase)
+
     def report(self, message):
         """
         Prints the supplied message, provided that  the --verbose option has
@@ -428,30 +2035,2136 @@ class Dexter():
         if self.verbose:
             print message
 
-    def get_files(self, path):
+    def walk_files(self, path):
+        """
+        Yields a (filespec, signature) tuple for each textfile in the
+        specified path, and in all of its sub-folders if the recurse option
+        has been set. Hidden files and folders (those whose names begin with
+        '.') are skipped.
+
+        The folders still to be searched are held on a stack rather than
+        being searched recursively, so that very deep trees cannot exceed
+        the recursion limit, and the files in each folder are yielded before
+        its sub-folders are searched.
+
+        If a walk depth has been set, the folders at that depth below the
+        path are not searched (they are the shards of a sharded index).
+        """
+        folders = [(path, 0)]
+        while folders:
+            (folder, depth) = folders.pop()
+            if folder != path:
+                self.report("Building index for %s" % folder)
+            sub_folders = []
+            for (filespec, is_dir) in self.list_folder(folder):
+                if is_dir:
+                    if self.recurse and depth + 1 != self.walk_depth:
+                        sub_folders.append((filespec, depth + 1))
+                else:
+                    try:
+                        signature = self.file_signature(filespec)
+                    except OSError:
+                        # The file has been removed, is a broken link, or is
+                        # not a regular file
+                        continue
+                    if self.is_textfile(filespec, signature):
+                        yield (filespec, signature)
+            # Reverse the sub-folders, so they are popped in their original order
+            folders.extend(reversed(sub_folders))
+
+    def list_folder(self, folder):
         """
-        Returns a list of the textfiles in the specified path.
+        Returns a list of (filespec, is_dir) tuples for the entries in the
+        specified folder, excluding hidden entries. A folder which cannot be
+        read is reported and treated as empty.
+
+        Where scandir is available the type of each entry is usually known
+        from the folder listing itself, avoiding a separate stat call for
+        each entry.
         """
-        base_list = glob.glob(os.path.join(path, "*"))
-        files = [filespec for filespec in base_list if self.is_textfile(filespec) or (os.path.isdir(filespec) and self.recurse)]
-        return files
+        try:
+            if scandir:
+                return [(entry.path, entry.is_dir()) for entry in scandir(folder) if not entry.name.startswith(".")]
+            else:
+                entries = [os.path.join(folder, name) for name in os.listdir(folder) if not name.startswith(".")]
+                return [(filespec, os.path.isdir(filespec)) for filespec in entries]
+        except OSError:
+            self.report("Unable to read %s" % folder)
+            return []
 
-    def is_textfile(self, filespec):
+    def is_textfile(self, filespec, signature=None):
         """
         Returns True if the supplied filespec appears to be a text file. If
         the file has an extension which usually indicates a text file, this
-        test automatically returns True, otherwise it returns False.
+        test automatically returns True, otherwise the start of the file is
+        examined (see sniff_file).
+
+        Dexter's own files, and files larger than the maximum size (if one
+        has been set), are never treated as text files.
 
-        TODO: implement a decent check
+        The result of examining a file is cached against its inode and
+        modification time, so that unchanged files are not examined again
+        the next time the index is built. The signature is the (size, mtime,
+        inode) tuple for the file, if it is already known.
         """
         filename, ext = os.path.splitext(filespec)
-        return (ext in [".txt", ".md", ".py", ".cpp", ".c", ".h", ".hpp", ".pas", ".sql"])
-    
-if (__name__ == "__main__"):
-    params = docopt(__doc__, version='Dexter, v0.0.9')
+        if is_dexter_file(os.path.basename(filespec)):
+            return False
+        if signature is None:
+            signature = self.file_signature(filespec)
+        (size, mtime, inode) = signature
+        if self.max_size and size > self.max_size:
+            return False
+        if ext in [".txt", ".md", ".py", ".cpp", ".c", ".h", ".hpp", ".pas", ".sql"]:
+            return True
+        key = (inode, mtime)
+        if key in self.sniff_cache:
+            result = self.sniff_cache[key]
+        else:
+            try:
+                result = self.sniff_file(filespec)
+            except IOError:
+                return False
+        # Only the files found in this run are kept in the cache
+        self.sniffed[key] = result
+        return result
 
-    #print params
-    
-    api = Dexter()
-    api.execute(params)
+    def sniff_file(self, filespec):
+        """
+        Returns True if the start of the specified file looks like text. The
+        file is treated as binary if the start of it contains a null byte, or
+        if more than 10% of it is made up of control characters. Characters
+        outside the ASCII range are allowed, so that UTF-8 and other 8-bit
+        encodings count as text.
+        """
+        with open(filespec, "rb") as f:
+            sample = f.read(SNIFF_SIZE)
+        if "\0" in sample:
+            return False
+        control_characters = sample.translate(None, TEXT_CHARACTERS)
+        return len(control_characters) * 10 <= len(sample)
+
+class Statistics():
+
+    """
+    Timings and counts for the phases of a command, collected when the
+    --stats option is given. The wall-clock and CPU time of each phase are
+    accumulated separately, so a phase such as 'tokenize' can be timed
+    across many short intervals. With --jobs, the times for the phases run
+    by the worker processes are totals across all the workers.
+
+    After a command has been run the statistics are available from the
+    'stats' attribute of the Dexter instance, and results() returns them
+    as a dictionary.
+    """
+
+    PHASES = ("walk", "read", "tokenize", "insert", "merge", "save", "load", "search", "list")
+    COUNTERS = ("files", "bytes", "tokens", "ignored", "terms", "postings")
+
+    def __init__(self):
+        self.wall = dict.fromkeys(self.PHASES, 0.0)
+        self.cpu = dict.fromkeys(self.PHASES, 0.0)
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self.started = {}
+
+    def start(self, phase):
+        """
+        Starts timing the specified phase.
+        """
+        self.started[phase] = (time.time(), time.clock())
+
+    def stop(self, phase):
+        """
+        Stops timing the specified phase, adding the time since it was
+        started to its totals.
+        """
+        (wall, cpu) = self.started.pop(phase)
+        self.wall[phase] += time.time() - wall
+        self.cpu[phase] += time.clock() - cpu
+
+    def count(self, counter, amount=1):
+        """
+        Adds the amount to the specified counter.
+        """
+        self.counts[counter] += amount
+
+    def merge(self, other):
+        """
+        Adds the timings and counts from another Statistics instance to the
+        ones in this instance.
+        """
+        for phase in self.PHASES:
+            self.wall[phase] += other.wall[phase]
+            self.cpu[phase] += other.cpu[phase]
+        for counter in self.COUNTERS:
+            self.counts[counter] += other.counts[counter]
+
+    def set_totals(self, dictionary):
+        """
+        Sets the number of terms (distinct words) and postings (locations)
+        from the supplied dictionary.
+        """
+        self.counts["terms"] = len(dictionary)
+        self.counts["postings"] = dictionary.location_count()
+
+    def results(self):
+        """
+        Returns the statistics as a dictionary, with a "phases" entry giving
+        the wall and CPU time of each phase which took any time, and an entry
+        for each of the counts.
+        """
+        results = dict(self.counts)
+        results["phases"] = dict((phase, {"wall": self.wall[phase], "cpu": self.cpu[phase]})
+            for phase in self.PHASES if self.wall[phase] or self.cpu[phase])
+        return results
+
+    def report(self, output):
+        """
+        Prints the statistics to the supplied output stream.
+        """
+        print >> output, "{:10} {:>10} {:>10}".format("Phase", "Wall (s)", "CPU (s)")
+        for phase in self.PHASES:
+            if self.wall[phase] or self.cpu[phase]:
+                print >> output, "{:10} {:10.4f} {:10.4f}".format(phase, self.wall[phase], self.cpu[phase])
+        for counter in self.COUNTERS:
+            print >> output, "{:10} {:>10}".format(counter, self.counts[counter])
+
+
+class Postings():
+
+    """
+    Dictionary of words and the locations at which they were found.
+
+    Rather than holding a (filespec, line_number) tuple for each location,
+    each filespec is held once, in a file table, and the locations of each
+    word are held in a single array of unsigned integers, as pairs of file
+    and line numbers. The locations of a word can be retrieved as a list of
+    (filespec, line_number) tuples by indexing the dictionary by the word.
+
+    If the dictionary is created with positions, each location also holds
+    the position of the word within its line (counting the words before it
+    on the line, including ignored ones), and is retrieved as a (filespec,
+    line_number, position) tuple.
+    """
+
+    # Approximate number of bytes of memory used by each word, location and
+    # file, excluding the length of the word or filename itself
+    WORD_SIZE = 150
+    LOCATION_SIZE = 8
+    FILE_SIZE = 100
+
+    def __init__(self, positions=False):
+        self.positions = positions
+        self.stride = 3 if positions else 2
+        self.files = []
+        self.file_numbers = {}
+        self.words = {}
+        self.size = 0
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __getitem__(self, word):
+        return list(self.locations(word))
+
+    def find(self, word):
+        """
+        Returns the list of (filespec, line_number) locations for the supplied
+        word, in the same way as the index file readers do. Raises a KeyError
+        if the word is not in the dictionary.
+        """
+        return self[word]
+
+    def match(self, pattern):
+        """
+        Yields a (word, locations) tuple for each word which matches the
+        supplied pattern, in word order.
+        """
+        (prefix, suffix, regex) = pattern_parts(pattern)
+        for word in sorted(word for word in self.words if regex.match(word)):
+            yield (word, self[word])
+
+    def file_number(self, filespec):
+        """
+        Returns the number of the supplied filespec in the file table,
+        adding it to the table if it is not already there.
+        """
+        number = self.file_numbers.get(filespec)
+        if number is None:
+            number = len(self.files)
+            self.files.append(filespec)
+            self.file_numbers[filespec] = number
+            self.size += self.FILE_SIZE + len(filespec)
+        return number
+
+    def add(self, word, filespec, line_number, position=0):
+        """
+        Adds a location to the supplied word, adding the word if it is not
+        already in the dictionary. The position is ignored if the dictionary
+        does not have positions.
+        """
+        entries = self.words.get(word)
+        if entries is None:
+            entries = self.words[word] = array.array("I")
+            self.size += self.WORD_SIZE + len(word)
+        entries.append(self.file_number(filespec))
+        entries.append(line_number)
+        if self.positions:
+            entries.append(position)
+        self.size += self.LOCATION_SIZE
+
+    def add_tokens(self, filespec, tokens, ignore_words, line_number=1):
+        """
+        Adds the locations of the words in the supplied list of words and
+        newlines from the specified file (see Tokenizer.tokens), counting the
+        lines from the supplied number of the first line, and skipping the
+        words which are to be ignored. This does the same as calling add()
+        for each word, but much faster. Returns the number of the line after
+        the last newline, and the number of words which were ignored.
+        """
+        words = self.words
+        number = self.file_number(filespec)
+        positions = self.positions
+        position = 0
+        added = 0
+        ignored = 0
+        for word in tokens:
+            if word == "\n":
+                line_number += 1
+                position = 0
+                continue
+            if word in ignore_words:
+                ignored += 1
+            else:
+                entries = words.get(word)
+                if entries is None:
+                    entries = words[word] = array.array("I")
+                    self.size += self.WORD_SIZE + len(word)
+                entries.append(number)
+                entries.append(line_number)
+                if positions:
+                    entries.append(position)
+                added += 1
+            position += 1
+        self.size += added * self.LOCATION_SIZE
+        return (line_number, ignored)
+
+    def locations(self, word):
+        """
+        Yields the (filespec, line_number) locations of the supplied word, or
+        the (filespec, line_number, position) locations if the dictionary has
+        positions. Raises a KeyError if the word is not in the dictionary.
+        """
+        entries = self.words[word]
+        files = self.files
+        if self.positions:
+            for i in xrange(0, len(entries), 3):
+                yield (files[entries[i]], entries[i + 1], entries[i + 2])
+        else:
+            for i in xrange(0, len(entries), 2):
+                yield (files[entries[i]], entries[i + 1])
+
+    def count(self, word):
+        """
+        Returns the number of locations of the supplied word.
+        """
+        return len(self.words[word]) // self.stride
+
+    def statistics(self):
+        """
+        Yields a (word, locations, files) tuple for each word, giving the
+        number of locations of the word and the number of files they are in.
+        """
+        stride = self.stride
+        for word, entries in self.words.iteritems():
+            yield (word, len(entries) // stride, len(set(entries[0::stride])))
+
+    def location_count(self):
+        """
+        Returns the total number of locations of all the words.
+        """
+        return sum(len(entries) for entries in self.words.itervalues()) // self.stride
+
+    def merge(self, other):
+        """
+        Adds the words and locations from another Postings instance to this
+        one, renumbering its files to match the file table of this one. Both
+        instances must either have positions or not, otherwise a ValueError
+        is raised.
+        """
+        if other.stride != self.stride:
+            raise ValueError("Cannot merge postings with and without positions")
+        numbers = [self.file_number(filespec) for filespec in other.files]
+        for word, other_entries in other.words.iteritems():
+            entries = self.words.get(word)
+            if entries is None:
+                entries = self.words[word] = array.array("I")
+                self.size += self.WORD_SIZE + len(word)
+            self.size += self.LOCATION_SIZE * (len(other_entries) // self.stride)
+            for i in xrange(0, len(other_entries), self.stride):
+                entries.append(numbers[other_entries[i]])
+                entries.extend(other_entries[i + 1:i + self.stride])
+
+    def remove_files(self, filespecs):
+        """
+        Removes all the locations in the supplied files, dropping any words
+        which no longer have any locations.
+        """
+        numbers = set(self.file_numbers[filespec] for filespec in filespecs if filespec in self.file_numbers)
+        if not numbers:
+            return
+        for word in self.words.keys():
+            entries = self.words[word]
+            kept = array.array("I")
+            for i in xrange(0, len(entries), self.stride):
+                if entries[i] not in numbers:
+                    kept.extend(entries[i:i + self.stride])
+            if kept:
+                self.words[word] = kept
+            else:
+                del self.words[word]
+
+
+class Tokenizer():
+
+    """
+    Extracts words from text. A word is any run of letters of at least the
+    minimum length, and is returned in lower-case.
+
+    Rather than examining the text one character at a time, the tokenizer
+    lower-cases the whole of the text and extracts the words with a single
+    precompiled regular expression, so that the work is done in one pass
+    by the regular expression engine.
+    """
+
+    def __init__(self, min_length=3):
+        self.min_length = min_length
+        self.pattern = re.compile("[a-z]{%d,}" % min_length)
+        self.line_pattern = re.compile("[a-z]{%d,}|\n" % min_length)
+
+    def words(self, text):
+        """
+        Returns a list of all the words found in the supplied text.
+        """
+        return self.pattern.findall(text.lower())
+
+    def lines(self, text, line_number=1):
+        """
+        Returns a list of (line_number, words) tuples for the lines of the
+        supplied text which contain any words, where the text can span any
+        number of lines. Line numbers are counted from the supplied number
+        of the first line.
+        """
+        findall = self.pattern.findall
+        result = []
+        for line in text.lower().split("\n"):
+            words = findall(line)
+            if words:
+                result.append((line_number, words))
+            line_number += 1
+        return result
+
+    def tokens(self, text):
+        """
+        Returns a list of all the words found in the supplied text, in which
+        each newline in the text also appears, as "\\n", so that the lines
+        the words are on can be counted without splitting the text into
+        lines.
+        """
+        return self.line_pattern.findall(text.lower())
+
+
+def is_dexter_file(filename):
+    """
+    Returns True if the supplied filename is one of Dexter's own files, or
+    one of the temporary files it creates while building the index, which
+    must not be indexed.
+    """
+    if filename in DEXTER_FILES:
+        return True
+    if filename.startswith(RUN_PREFIX) and filename.endswith(RUN_SUFFIX):
+        return True
+    return filename.endswith(TEMP_SUFFIX) and filename[:-len(TEMP_SUFFIX)] in DEXTER_FILES
+
+def replace_file(source, target):
+    """
+    Renames the source file to the target, replacing the target if it
+    exists. On POSIX systems the rename replaces the target atomically, so
+    the target can be read throughout; Windows cannot rename over an
+    existing file, so there the target has to be removed first.
+    """
+    if os.name == "nt" and os.path.exists(target):
+        os.remove(target)
+    os.rename(source, target)
+
+
+# --------------------------------------------------------------------------
+# Pattern matching
+# --------------------------------------------------------------------------
+
+def is_pattern(word):
+    """
+    Returns True if the supplied word contains any wildcards.
+    """
+    return any(char in WILDCARDS for char in word)
+
+def pattern_parts(pattern):
+    """
+    Splits the supplied pattern into the literal text before the first
+    wildcard (the prefix) and the literal text after the last wildcard (the
+    suffix), returning them with a compiled regular expression matching the
+    whole pattern.
+    """
+    first = min(pattern.find(char) for char in WILDCARDS if char in pattern)
+    last = max(pattern.rfind(char) for char in WILDCARDS + "]")
+    return (pattern[:first], pattern[last + 1:], re.compile(fnmatch.translate(pattern)))
+
+
+# --------------------------------------------------------------------------
+# Fuzzy matching
+# --------------------------------------------------------------------------
+
+def deletions(word, distance):
+    """
+    Returns the set of strings made by deleting up to the supplied number of
+    letters from the word, including the word itself.
+    """
+    result = set([word])
+    current = result
+    for i in xrange(distance):
+        current = set(text[:j] + text[j + 1:] for text in current for j in xrange(len(text)))
+        result.update(current)
+    return result
+
+def sort_records(records, path, run_size=FUZZY_RUN_SIZE):
+    """
+    Yields the supplied (deletion, word) records in order, holding no more
+    than run_size of them in memory. If there are more, each run_size
+    records are sorted and written to a temporary run file in the path, and
+    the runs are merged, then deleted once they have been read.
+    """
+    import tempfile
+    runs = []
+    try:
+        while True:
+            run = sorted(itertools.islice(records, run_size))
+            if len(run) < run_size and not runs:
+                for record in run:
+                    yield record
+                return
+            if not run:
+                break
+            (handle, filespec) = tempfile.mkstemp(prefix=RUN_PREFIX, suffix=RUN_SUFFIX, dir=path)
+            runs.append(filespec)
+            with os.fdopen(handle, "wb") as f:
+                for deletion, word in run:
+                    f.write("%s|%s\n" % (deletion, word))
+        run_files = [open(filespec, "rb") for filespec in runs]
+        try:
+            for record in heapq.merge(*[read_fuzzy_records(f) for f in run_files]):
+                yield record
+        finally:
+            for f in run_files:
+                f.close()
+    finally:
+        for filespec in runs:
+            os.remove(filespec)
+
+def read_fuzzy_records(f, removed=()):
+    """
+    Reads an open file in the dexter.fuzzy format, yielding a (deletion,
+    word) tuple for each record, and skipping the records of any of the
+    removed words.
+    """
+    for line in f:
+        (deletion, word) = line.rstrip("\n").split("|")
+        if word not in removed:
+            yield (deletion, word)
+
+def read_fuzzy_words(f):
+    """
+    Reads an open file in the dexter.fuzzy format, yielding each of the
+    words it holds records for. Every word is one of its own deletions, so
+    this is the word of each record whose deletion is the whole word.
+    """
+    for line in f:
+        (deletion, word) = line.rstrip("\n").split("|")
+        if deletion == word:
+            yield word
+
+def edit_distance(first, second):
+    """
+    Returns the number of letters which have to be inserted, deleted,
+    changed or swapped with the next letter to turn the first word into the
+    second (the optimal string alignment distance).
+    """
+    previous = None
+    row = range(len(second) + 1)
+    for i in xrange(1, len(first) + 1):
+        (before, previous, row) = (previous, row, [i] + [0] * len(second))
+        for j in xrange(1, len(second) + 1):
+            cost = 0 if first[i - 1] == second[j - 1] else 1
+            row[j] = min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and first[i - 1] == second[j - 2] and first[i - 2] == second[j - 1]:
+                row[j] = min(row[j], before[j - 2] + 1)
+    return row[len(second)]
+
+
+# --------------------------------------------------------------------------
+# Queries
+# --------------------------------------------------------------------------
+
+def is_query(word):
+    """
+    Returns True if the supplied word is a query of several words, or a
+    phrase.
+    """
+    return len(word.split()) > 1 or '"' in word
+
+def intersect_locations(first, second):
+    """
+    Merges two lists of (filespec, line_number) locations, each sorted by
+    file and line number, keeping only the locations in the files which
+    appear in both lists.
+    """
+    result = []
+    i = 0
+    j = 0
+    while i < len(first) and j < len(second):
+        if first[i][0] < second[j][0]:
+            i += 1
+        elif first[i][0] > second[j][0]:
+            j += 1
+        else:
+            filespec = first[i][0]
+            (first_start, second_start) = (i, j)
+            while i < len(first) and first[i][0] == filespec:
+                i += 1
+            while j < len(second) and second[j][0] == filespec:
+                j += 1
+            result.extend(union_locations(first[first_start:i], second[second_start:j]))
+    return result
+
+def union_locations(first, second):
+    """
+    Merges two lists of (filespec, line_number) locations, each sorted by
+    file and line number, into a single sorted list without duplicates.
+    """
+    result = []
+    for location in heapq.merge(first, second):
+        if not result or result[-1] != location:
+            result.append(location)
+    return result
+
+def follow_locations(first, second, offset):
+    """
+    Merges two lists of (filespec, line_number, position) locations, each
+    sorted by file, line number and position, returning the locations from
+    the first list which have a location in the second list on the same line
+    and the supplied number of words after it.
+    """
+    result = []
+    j = 0
+    for location in first:
+        target = (location[0], location[1], location[2] + offset)
+        while j < len(second) and second[j] < target:
+            j += 1
+        if j == len(second):
+            break
+        if second[j] == target:
+            result.append(location)
+    return result
+
+def near_locations(first, second, distance):
+    """
+    Merges two lists of (filespec, line_number, position) locations, each
+    sorted by file, line number and position, keeping only the locations
+    which are within the supplied number of words of a location in the other
+    list on the same line.
+    """
+    result = []
+    i = 0
+    j = 0
+    while i < len(first) and j < len(second):
+        if first[i][:2] < second[j][:2]:
+            i += 1
+        elif first[i][:2] > second[j][:2]:
+            j += 1
+        else:
+            line = first[i][:2]
+            (first_start, second_start) = (i, j)
+            while i < len(first) and first[i][:2] == line:
+                i += 1
+            while j < len(second) and second[j][:2] == line:
+                j += 1
+            first_line = first[first_start:i]
+            second_line = second[second_start:j]
+            result.extend(union_locations(
+                [a for a in first_line if any(abs(a[2] - b[2]) <= distance for b in second_line)],
+                [b for b in second_line if any(abs(a[2] - b[2]) <= distance for a in first_line)]))
+    return result
+
+def exclude_locations(first, second):
+    """
+    Returns the locations from the first list which are not in any of the
+    files which appear in the second list.
+    """
+    files = set(location[0] for location in second)
+    return [location for location in first if location[0] not in files]
+
+
+class Query():
+
+    """
+    A query of several words combined with AND, OR and NOT, such as
+    'open AND file NOT close' or 'read OR write'. Words with no operator
+    between them are treated as joined by AND, and AND binds more tightly
+    than OR, so 'open file OR socket' finds the files with both 'open' and
+    'file' in them, and the files with 'socket' in them. The words can be
+    patterns, such as 'conf*'.
+
+    If the index has positions, a word can also be a quoted phrase, such as
+    '"connection reset"', which matches the words next to each other on a
+    line, or a pair of words joined by NEAR/k, such as 'connection NEAR/3
+    reset', which matches the words within k words of each other on a line.
+    Ignored words in a phrase are skipped, but still have to be there.
+
+    Words which are never indexed (ignored words, and words shorter than the
+    minimum length) are left out of the query, so 'the parser' finds the
+    files with 'parser' in them.
+
+    The query is matched against each file, and the result is the lines in
+    the files which satisfy it where the words of the query were found.
+    """
+
+    def __init__(self, text, ignore_words=()):
+        self.text = text
+        self.ignore_words = ignore_words
+        self.tokenizer = Tokenizer()
+        self.groups = self.parse(text)
+        self.cache = {}
+
+    def parse(self, text):
+        """
+        Splits the supplied query into the groups of terms separated by OR,
+        returning a list of (included, excluded) tuples, where included is
+        the list of terms which must be in a file and excluded is the list of
+        terms which must not be. Raises a ValueError if the query is invalid.
+
+        Each term is a word, a ("phrase", ((offset, word), ...)) tuple giving
+        the offset of each word from the start of the phrase, or a ("near",
+        term, term, distance) tuple. Words which are never indexed are left
+        out, and cannot be joined by NEAR.
+        """
+        groups = []
+        included = []
+        excluded = []
+        last = None
+        negate = False
+        near = None
+        for token in re.findall('"[^"]*"|\\S+', text) + ["OR"]:
+            distance = re.match("NEAR/(\\d+)$", token)
+            if near is not None and (distance or token in ("AND", "OR", "NOT")):
+                raise ValueError("Invalid query: NEAR must be followed by a word in '%s'" % text)
+            if distance:
+                if last is None or negate:
+                    raise ValueError("Invalid query: NEAR must follow a word in '%s'" % text)
+                near = int(distance.group(1))
+            elif token == "OR":
+                if negate or (excluded and not included):
+                    raise ValueError("Invalid query: each part of '%s' must include a word which is not excluded" % text)
+                if included:
+                    groups.append((included, excluded))
+                included = []
+                excluded = []
+                last = None
+            elif token == "NOT":
+                negate = True
+            elif token != "AND":
+                term = self.term(token)
+                if term is None:
+                    if near is not None:
+                        raise ValueError("Invalid query: NEAR must be followed by a word in '%s'" % text)
+                    last = None
+                    negate = False
+                    continue
+                if near is not None:
+                    last[-1] = ("near", last[-1], term, near)
+                    near = None
+                else:
+                    last = excluded if negate else included
+                    last.append(term)
+                negate = False
+        if not groups:
+            raise ValueError("Invalid query: no words to search for in '%s'" % text)
+        return groups
+
+    def term(self, token):
+        """
+        Returns the term for the supplied token of the query, which is either
+        a word or a quoted phrase, or None for a word which is never indexed.
+        Raises a ValueError if a phrase has no words which are in the index.
+        """
+        if not token.startswith('"'):
+            word = token.lower()
+            if not is_pattern(word) and (word in self.ignore_words or len(word) < self.tokenizer.min_length):
+                return None
+            return word
+        words = tuple((offset, word) for offset, word in enumerate(self.tokenizer.words(token))
+            if word not in self.ignore_words)
+        if not words:
+            raise ValueError("Invalid query: no words to search for in %s" % token)
+        if len(words) == 1:
+            return words[0][1]
+        return ("phrase", words)
+
+    def evaluate(self, index):
+        """
+        Evaluates the query against the supplied index, returning the sorted
+        list of (filespec, line_number) locations which satisfy it.
+        """
+        result = []
+        for included, excluded in self.groups:
+            result = union_locations(result, self.evaluate_group(index, included, excluded))
+
+        # Report each line once, whatever the positions on it
+        lines = []
+        for location in result:
+            if not lines or lines[-1] != location[:2]:
+                lines.append(location[:2])
+        return lines
+
+    def evaluate_group(self, index, included, excluded):
+        """
+        Returns the locations of the included words in the files which have
+        all of them and none of the excluded words.
+        """
+        # Start from the rarest term, so that the intermediate results stay as
+        # small as possible, and stop as soon as no files are left
+        try:
+            counts = sorted((self.count(index, term), term) for term in included)
+        except KeyError:
+            return []
+        result = self.locations(index, counts[0][1])
+        for count, term in counts[1:]:
+            if not result:
+                break
+            result = intersect_locations(result, self.locations(index, term))
+        for term in excluded:
+            if not result:
+                break
+            try:
+                result = exclude_locations(result, self.locations(index, term))
+            except KeyError:
+                pass
+        return result
+
+    def count(self, index, term):
+        """
+        Returns the number of locations of the supplied term. Raises a
+        KeyError if a word of the term is not in the index.
+        """
+        if isinstance(term, tuple) or is_pattern(term) or term in self.cache:
+            return len(self.locations(index, term))
+        return index.count(term)
+
+    def locations(self, index, term):
+        """
+        Returns the locations of the supplied term, sorted by file, line
+        number and position. Raises a KeyError if a word of the term is not
+        in the index.
+        """
+        if term not in self.cache:
+            if isinstance(term, tuple) and term[0] == "phrase":
+                locations = self.phrase_locations(index, term[1])
+            elif isinstance(term, tuple):
+                locations = near_locations(self.positional_locations(index, term[1]),
+                    self.positional_locations(index, term[2]), term[3])
+            elif is_pattern(term):
+                locations = []
+                for match, match_locations in index.match(term):
+                    locations = union_locations(locations, sorted(match_locations))
+                if not locations:
+                    raise KeyError(term)
+            else:
+                locations = sorted(index.find(term))
+            self.cache[term] = locations
+        return self.cache[term]
+
+    def phrase_locations(self, index, words):
+        """
+        Returns the locations of the start of the phrase made up of the
+        supplied (offset, word) tuples, matching the rarest word first.
+        """
+        words = sorted(words, key=lambda (offset, word): self.count(index, word))
+        (offset, word) = words[0]
+        result = [(location[0], location[1], location[2] - offset)
+            for location in self.positional_locations(index, word)]
+        for offset, word in words[1:]:
+            if not result:
+                break
+            result = follow_locations(result, self.positional_locations(index, word), offset)
+        return result
+
+    def positional_locations(self, index, term):
+        """
+        Returns the locations of the supplied term, in the same way as
+        locations(), but raises a ValueError if the index has no positions.
+        """
+        locations = self.locations(index, term)
+        if locations and len(locations[0]) < 3:
+            raise ValueError("Phrase and NEAR queries need an index built with --positions")
+        return locations
+
+
+# --------------------------------------------------------------------------
+# Merging of sorted index files
+# --------------------------------------------------------------------------
+
+def format_record(word, location):
+    """
+    Returns the record in the dexter.index format for the supplied word and
+    (filespec, line_number) location. If the location also has a position,
+    it is written after the line number, as 'line:position'.
+    """
+    if len(location) == 3:
+        return "{:20}|{:06d}:{}|{}\n".format(word, location[1], location[2], location[0])
+    return "{:20}|{:06d}|{}\n".format(word, location[1], location[0])
+
+def parse_record(line):
+    """
+    Returns the (word, location) tuple for the supplied record in the
+    dexter.index format, where the location is a (filespec, line_number) or
+    a (filespec, line_number, position) tuple.
+    """
+    (word, line_number, filespec) = line.rstrip("\n").split("|", 2)
+    if ":" in line_number:
+        (line_number, position) = line_number.split(":")
+        return (word.strip(), (filespec, int(line_number), int(position)))
+    return (word.strip(), (filespec, int(line_number)))
+
+def read_text_groups(f, source, stale=()):
+    """
+    Reads an open index (or run) file in the dexter.index format, yielding a
+    (word, source, locations) tuple for each word in turn, where locations
+    is the list of (filespec, line_number) tuples for the word. Locations in
+    any of the stale files are skipped.
+
+    The source number identifies the file when the groups from several files
+    are merged, so that groups for the same word are merged in file order.
+    """
+    current = None
+    locations = []
+    for line in f:
+        (word, location) = parse_record(line)
+        if location[0] in stale:
+            continue
+        if word != current:
+            if locations:
+                yield (current, source, locations)
+            current = word
+            locations = []
+        locations.append(location)
+    if locations:
+        yield (current, source, locations)
+
+def merge_groups(groups):
+    """
+    Combines consecutive groups for the same word from a merged sequence of
+    (word, source, locations) groups, yielding a (word, locations) tuple for
+    each distinct word.
+    """
+    current = None
+    locations = []
+    for word, source, group in groups:
+        if word != current:
+            if locations:
+                yield (current, locations)
+            current = word
+            locations = []
+        locations.extend(group)
+    if locations:
+        yield (current, locations)
+
+
+# --------------------------------------------------------------------------
+# Worker process functions for parallel indexing (--jobs)
+# --------------------------------------------------------------------------
+
+# Each worker process scans its files with its own Dexter instance
+worker = None
+
+def init_worker(ignore_words, verbose, stats, positions, path, memory):
+    """
+    Initialises a worker process, creating the Dexter instance which will
+    scan the files passed to it. If stats is True, the worker collects
+    statistics as it scans the files, and if positions is True it records
+    the position of each word within its line. If the worker has a memory
+    budget, it writes what it scans out as runs in the path.
+    """
+    global worker
+    worker = Dexter()
+    worker.tokenizer = Tokenizer()
+    worker.ignore_words = ignore_words
+    worker.verbose = verbose
+    worker.collect_stats = stats
+    worker.positions = positions
+    worker.path = path
+    worker.memory = memory
+
+def scan_chunk(file_list):
+    """
+    Scans the supplied files in a worker process, returning the partial
+    dictionary (a Postings instance) of the words found in them, the list of
+    runs it has been written out to, and the statistics for the scan, or
+    None if statistics are not being collected. If the worker has a memory
+    budget, the whole of the partial dictionary is written out as runs, and
+    None is returned in its place.
+    """
+    worker.dictionary = Postings(worker.positions)
+    worker.runs = []
+    worker.stats = Statistics() if worker.collect_stats else None
+    for filespec in file_list:
+        worker.scan_file(filespec)
+        worker.check_memory()
+    if worker.memory:
+        if len(worker.dictionary):
+            worker.flush_run()
+        worker.dictionary = None
+    return (worker.dictionary, worker.runs, worker.stats)
+
+
+def read_files(requests):
+    """
+    Reads files for Dexter.scan_files_pipelined, in a reader thread. Each
+    request is the filespec of a file and a queue, to which a (text, error)
+    tuple is put once the file has been read: the text is None for a large
+    file, which is left to be scanned in chunks, and error is the IOError
+    raised when reading the file, if there was one. A request of None stops
+    the thread.
+    """
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        (filespec, contents) = request
+        try:
+            if os.path.getsize(filespec) >= LARGE_FILE_SIZE:
+                contents.put((None, None))
+            else:
+                with open(filespec, "r") as f:
+                    contents.put((f.read(), None))
+        except (IOError, OSError) as e:
+            contents.put((None, e))
+
+def index_shard(arguments):
+    """
+    Builds or updates the index of one shard of a sharded index, in the
+    current process or in a worker process. The arguments are the params
+    of the command, the path of the shard, and the depth at which the walk
+    stops (for the shard at the top of the sharded path), or None.
+    """
+    (params, path, depth) = arguments
+    params = dict(params)
+    params.update({"<path>": path, "--recurse": True, "--shards": "0", "--jobs": "1",
+        "--stats": False, "--fuzzy": False})
+    shard = Dexter()
+    if shard.setup(params):
+        shard.shards = None
+        shard.walk_depth = depth
+        shard.make_index()
+
+
+# --------------------------------------------------------------------------
+# Watching for changes (watch)
+# --------------------------------------------------------------------------
+
+class InotifyWatcher():
+
+    """
+    Reports the files and folders which change in a folder (and in its
+    sub-folders, if recurse is True) using the Linux inotify interface,
+    through ctypes. list_folder is a function returning (filespec, is_dir)
+    tuples for the entries in a folder, as Dexter.list_folder does.
+
+    Raises OSError if inotify is not available, or if the folders cannot be
+    watched, which is usually because there are more of them than the limit
+    on the number of watches (fs.inotify.max_user_watches) allows.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, path, recurse, list_folder):
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.add_watch = libc.inotify_add_watch
+            self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.path = path
+        self.recurse = recurse
+        self.list_folder = list_folder
+        self.folders = {}
+        try:
+            self.watch_folder(path)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def watch_folder(self, folder):
+        """
+        Starts watching the specified folder, and its sub-folders if recurse
+        is True. Folders which have already gone are ignored.
+        """
+        import ctypes
+        folders = [folder]
+        while folders:
+            folder = folders.pop()
+            watch = self.add_watch(self.fd, folder, self.MASK)
+            if watch < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise OSError(error, "Cannot watch %s: %s" % (folder, os.strerror(error)))
+            self.folders[watch] = folder
+            if self.recurse:
+                try:
+                    folders.extend(filespec for (filespec, is_dir) in self.list_folder(folder) if is_dir)
+                except OSError:
+                    pass
+
+    def changes(self, timeout):
+        """
+        Waits for up to timeout seconds for changes, returning the set of the
+        files and folders which have changed, which is empty if none have.
+        Hidden files and folders are ignored. If changes have been lost
+        because too many were made at once, the path itself is returned, so
+        that all of it is checked.
+        """
+        (readable, writable, failed) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self.fd, 65536)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            (watch, mask, cookie, length) = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                changed.add(self.path)
+                continue
+            if mask & self.IN_IGNORED:
+                self.folders.pop(watch, None)
+                continue
+            folder = self.folders.get(watch)
+            if folder is None or not name or name.startswith("."):
+                continue
+            filespec = os.path.join(folder, name)
+            if mask & self.IN_ISDIR:
+                if not self.recurse:
+                    continue
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self.watch_folder(filespec)
+            changed.add(filespec)
+        return changed
+
+
+class PollingWatcher():
+
+    """
+    Reports the files which change in a folder by walking it each time it is
+    asked for changes, and comparing the signature of each file with the one
+    it had the time before. walk is a function returning (filespec,
+    signature) tuples for the files in the folder.
+    """
+
+    def __init__(self, walk):
+        self.walk = walk
+        self.signatures = dict(walk())
+
+    def close(self):
+        pass
+
+    def changes(self, timeout):
+        """
+        Waits for timeout seconds, and then returns the set of the files which
+        have been added, changed or removed since the last check.
+        """
+        time.sleep(timeout)
+        signatures = dict(self.walk())
+        changed = set(filespec for filespec in signatures if self.signatures.get(filespec) != signatures[filespec])
+        changed.update(filespec for filespec in self.signatures if filespec not in signatures)
+        self.signatures = signatures
+        return changed
+
+
+# --------------------------------------------------------------------------
+# Compressed postings (--format=compressed)
+# --------------------------------------------------------------------------
+
+def encode_postings(entries, stride):
+    """
+    Compresses the supplied array of postings, as pairs of file and line
+    numbers (or triples of file and line numbers and positions, if stride
+    is 3), returning the compressed bytes.
+
+    The postings are sorted, and each is stored as the difference from the
+    file number of the previous posting, followed by the line number, which
+    is stored as the difference from the previous line number when the file
+    is the same, and then the position, which is stored as the difference
+    from the previous position when the line is the same. These numbers are
+    mostly small, so each one is written seven bits at a time, low bits
+    first, with the top bit of each byte set if more bytes follow.
+    """
+    postings = sorted(zip(*[iter(entries)] * stride))
+    data = bytearray()
+    previous = (0, 0, 0)
+    for posting in postings:
+        if posting[0] != previous[0]:
+            values = (posting[0] - previous[0],) + posting[1:]
+        elif stride == 3 and posting[1] == previous[1]:
+            values = (0, 0, posting[2] - previous[2])
+        else:
+            values = (0, posting[1] - previous[1]) + posting[2:]
+        for value in values:
+            while value >= 0x80:
+                data.append((value & 0x7f) | 0x80)
+                value >>= 7
+            data.append(value)
+        previous = posting
+    return str(data)
+
+def decode_postings(data, stride):
+    """
+    Decompresses the supplied bytes, written by encode_postings, returning
+    an array of the postings as pairs of file and line numbers (or triples
+    of file and line numbers and positions, if stride is 3).
+    """
+    values = array.array("I")
+    value = 0
+    shift = 0
+    for byte in bytearray(data):
+        if byte & 0x80:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+        else:
+            values.append(value | (byte << shift))
+            value = 0
+            shift = 0
+
+    # Undo the differences
+    for i in xrange(stride, len(values), stride):
+        if values[i] != 0:
+            values[i] += values[i - stride]
+        elif stride == 3 and values[i + 1] == 0:
+            values[i] = values[i - 3]
+            values[i + 1] = values[i - 2]
+            values[i + 2] += values[i - 1]
+        else:
+            values[i] = values[i - stride]
+            values[i + 1] += values[i - stride + 1]
+    return values
+
+
+class TextIndex():
+
+    """
+    Searches a dexter.index file without loading it.
+
+    The records in the file are sorted by word, so the reader can binary
+    search the file by byte offset, seeking to a position and skipping to
+    the start of the next record to find the word at that point, and then
+    read just the records for the word it is looking for.
+
+    Patterns which start with a wildcard are searched for using the
+    dexter.suffixes file beside the index (see SuffixFile), if it exists.
+
+    The index has positions if its records do, which is checked from the
+    first record. An empty index has no records to check, so empty is set
+    to show that positions cannot be told.
+    """
+
+    def __init__(self, filespec):
+        self.filespec = filespec
+        self.file = open(filespec, "rb")
+        fields = self.file.readline().split("|", 2)
+        self.positions = len(fields) == 3 and ":" in fields[1]
+        self.file.seek(0, os.SEEK_END)
+        self.file_size = self.file.tell()
+        self.empty = self.file_size == 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the underlying file.
+        """
+        self.file.close()
+
+    def find(self, word):
+        """
+        Returns the list of (filespec, line_number) locations for the supplied
+        word. Raises a KeyError if the word is not in the index.
+        """
+        self.seek(word)
+        locations = []
+        for line in self.file:
+            (record_word, location) = parse_record(line)
+            if record_word != word:
+                break
+            locations.append(location)
+        if not locations:
+            raise KeyError(word)
+        return locations
+
+    def count(self, word):
+        """
+        Returns the number of locations of the supplied word. Raises a
+        KeyError if the word is not in the index.
+        """
+        return len(self.find(word))
+
+    def load(self):
+        """
+        Reads the whole of the index, returning it as a Postings instance.
+        """
+        postings = Postings(self.positions)
+        self.file.seek(0)
+        for line in self.file:
+            (word, location) = parse_record(line)
+            postings.add(word, *location)
+        return postings
+
+    def statistics(self):
+        """
+        Yields a (word, locations, files) tuple for each word in the index,
+        giving the number of locations of the word and the number of files
+        they are in. Only the records of one word are held at a time.
+        """
+        self.file.seek(0)
+        for word, source, locations in read_text_groups(self.file, 0):
+            yield (word, len(locations), len(set(location[0] for location in locations)))
+
+    def words(self):
+        """
+        Yields each word in the index, in word order.
+        """
+        self.file.seek(0)
+        current = None
+        for line in self.file:
+            word = self.record_word(line)
+            if word != current:
+                current = word
+                yield word
+
+    def match(self, pattern):
+        """
+        Yields a (word, locations) tuple for each word which matches the
+        supplied pattern, in word order.
+
+        If the pattern starts with some letters, only the records for words
+        starting with them are read. Otherwise, if it ends with some letters,
+        the words ending with them are found from the dexter.suffixes file
+        and each of them is looked up. Failing both, the whole of the index
+        has to be read.
+        """
+        (prefix, suffix, regex) = pattern_parts(pattern)
+        suffix_filespec = os.path.join(os.path.dirname(self.filespec), "dexter.suffixes")
+        if not prefix and suffix and os.path.exists(suffix_filespec):
+            with SuffixFile(suffix_filespec) as suffixes:
+                words = sorted(word for word in suffixes.ending_with(suffix) if regex.match(word))
+            for word in words:
+                yield (word, self.find(word))
+            return
+
+        self.seek(prefix)
+        for word, source, locations in read_text_groups(self.file, 0):
+            if not word.startswith(prefix):
+                break
+            if regex.match(word):
+                yield (word, locations)
+
+    def seek(self, word):
+        """
+        Positions the file at the first record for the supplied word or for
+        the first word after it.
+        """
+        # Find the lowest offset at which the next record is for the word or
+        # a later one
+        low = 0
+        high = self.file_size
+        while low < high:
+            middle = (low + high) // 2
+            record_word = self.record_word(self.record_at(middle))
+            if record_word is not None and record_word < word:
+                low = middle + 1
+            else:
+                high = middle
+        self.record_at(low)
+
+    def record_at(self, offset):
+        """
+        Positions the file at the first record which starts at or after the
+        supplied offset, and returns that record without moving past it.
+        Returns an empty string if there is no such record.
+        """
+        if offset == 0:
+            self.file.seek(0)
+        else:
+            # Skip the remainder of the record which spans the offset
+            self.file.seek(offset - 1)
+            self.file.readline()
+        start = self.file.tell()
+        line = self.file.readline()
+        self.file.seek(start)
+        return line
+
+    def record_word(self, line):
+        """
+        Returns the word from the supplied record, or None for an empty
+        record (the end of the file).
+        """
+        if not line:
+            return None
+        return line.split("|", 1)[0].strip()
+
+
+class SuffixFile(TextIndex):
+
+    """
+    Searches a dexter.suffixes file, which holds every word in the index
+    reversed and sorted, one per line. Words ending with some letters are
+    found by binary-searching the file for the reversed letters.
+    """
+
+    def ending_with(self, suffix):
+        """
+        Yields each word which ends with the supplied suffix.
+        """
+        reversed_suffix = suffix[::-1]
+        self.seek(reversed_suffix)
+        for line in self.file:
+            reversed_word = line.rstrip("\n")
+            if not reversed_word.startswith(reversed_suffix):
+                break
+            yield reversed_word[::-1]
+
+    def record_word(self, line):
+        """
+        Returns the (reversed) word from the supplied record, or None for an
+        empty record (the end of the file).
+        """
+        if not line:
+            return None
+        return line.rstrip("\n")
+
+
+class FuzzyFile(TextIndex):
+
+    """
+    Searches a dexter.fuzzy file, which holds a 'deletion|word' record for
+    each of the strings (deletions) made by deleting up to FUZZY_DISTANCE
+    letters from each word in the index, sorted by deletion.
+
+    Two words are within an edit distance of k of each other only if some
+    deletion of at most k letters from one is also a deletion of at most k
+    letters from the other, so the words close to a word are found by
+    looking up each of its own deletions, and then checking the actual
+    distance of each word found.
+    """
+
+    def similar(self, word, distance):
+        """
+        Returns a list of (distance, word) tuples for the words within the
+        supplied edit distance of the word, sorted closest first.
+        """
+        candidates = set()
+        for deletion in deletions(word, distance):
+            candidates.update(self.words_with(deletion))
+        result = []
+        for candidate in candidates:
+            candidate_distance = edit_distance(word, candidate)
+            if candidate_distance <= distance:
+                result.append((candidate_distance, candidate))
+        return sorted(result)
+
+    def words_with(self, deletion):
+        """
+        Yields each word which the supplied deletion was made from.
+        """
+        self.seek(deletion)
+        for line in self.file:
+            (record_deletion, word) = line.rstrip("\n").split("|")
+            if record_deletion != deletion:
+                break
+            yield word
+
+    def record_word(self, line):
+        """
+        Returns the deletion from the supplied record, or None for an empty
+        record (the end of the file).
+        """
+        if not line:
+            return None
+        return line.split("|", 1)[0]
+
+
+class BloomFilter():
+
+    """
+    Reader and writer for the Bloom filter of the words in an index
+    (dexter.bloom), which shows that a word is not in the index without the
+    index having to be opened.
+
+    Each word sets HASH_COUNT bits in an array of BITS_PER_WORD bits per
+    word, chosen by hashing the word. A word whose bits are not all set is
+    certainly not in the index; if they are all set it is very likely to be
+    (about one in a hundred words which are not in the index look as though
+    they are). A lookup only reads the header and one byte for each bit.
+
+    The header records the format, size and modification time of the index
+    file which the filter was built for, and the filter is not used if the
+    index file has changed since:
+
+      header     magic, version, binary format flag, hash count, word count,
+                 bit count, index file size, index file modification time
+    """
+
+    MAGIC = "DEXB"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHBBIQQd")
+    BITS_PER_WORD = 10
+    HASH_COUNT = 7
+
+    @classmethod
+    def bits(cls, word, bit_count, hash_count):
+        """
+        Returns the numbers of the bits which the supplied word sets.
+        """
+        (first, second) = struct.unpack("<QQ", hashlib.md5(word).digest())
+        second |= 1
+        return [(first + i * second) % bit_count for i in xrange(hash_count)]
+
+    @classmethod
+    def index_filespec(cls, path, binary):
+        """
+        Returns the filespec of the index in the specified path which the
+        filter belongs to.
+        """
+        return os.path.join(path, "dexter.bindex" if binary else "dexter.index")
+
+    @classmethod
+    def write(cls, path, words, binary):
+        """
+        Writes the Bloom filter for the supplied words (any sequence with a
+        length) to dexter.bloom in the specified path, for the index in the
+        specified format, which must already have been written.
+        """
+        bit_count = max(64, len(words) * cls.BITS_PER_WORD)
+        bits = bytearray((bit_count + 7) // 8)
+        for word in words:
+            for bit in cls.bits(word, bit_count, cls.HASH_COUNT):
+                bits[bit >> 3] |= 1 << (bit & 7)
+        status = os.stat(cls.index_filespec(path, binary))
+        filespec = os.path.join(path, "dexter.bloom")
+        with open(filespec + TEMP_SUFFIX, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, 1 if binary else 0, cls.HASH_COUNT, len(words),
+                bit_count, status.st_size, status.st_mtime))
+            f.write(bits)
+        replace_file(filespec + TEMP_SUFFIX, filespec)
+
+    @classmethod
+    def lookup(cls, path, word):
+        """
+        Returns False if the Bloom filter in the specified path shows that the
+        word is not in the index in that path, otherwise True, including when
+        there is no filter or it is out of date.
+        """
+        try:
+            with open(os.path.join(path, "dexter.bloom"), "rb") as f:
+                (magic, version, binary, hash_count, word_count, bit_count, size, mtime) = cls.HEADER.unpack(
+                    f.read(cls.HEADER.size))
+                if magic != cls.MAGIC or version != cls.VERSION:
+                    return True
+                status = os.stat(cls.index_filespec(path, binary))
+                if (status.st_size, status.st_mtime) != (size, mtime):
+                    return True
+                for bit in cls.bits(word, bit_count, hash_count):
+                    f.seek(cls.HEADER.size + (bit >> 3))
+                    if not ord(f.read(1)) & (1 << (bit & 7)):
+                        return False
+        except (IOError, OSError, struct.error):
+            pass
+        return True
+
+
+class ShardedIndex():
+
+    """
+    Searches the indexes of the shards of a sharded index (see
+    Dexter.make_shards) as though they were a single index. Each shard is
+    searched in turn, or by a pool of threads if there is more than one
+    job, and the results are merged.
+
+    As each file belongs to exactly one shard, the locations and the counts
+    of files from the shards can simply be added together.
+
+    The index has positions if all of the shards which hold any words do.
+    An empty shard (such as the path itself, when all its files are in
+    sub-folders) cannot show whether it has positions, so it is not counted.
+    """
+
+    def __init__(self, paths, jobs=1):
+        self.shards = [self.open_shard(path) for path in paths]
+        self.positions = all(shard.positions for shard in self.shards if not shard.empty)
+        if jobs > 1 and len(self.shards) > 1:
+            import multiprocessing.pool
+            self.pool = multiprocessing.pool.ThreadPool(min(jobs, len(self.shards)))
+        else:
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the indexes of all the shards.
+        """
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        for shard in self.shards:
+            shard.close()
+
+    @classmethod
+    def shard_exists(cls, path):
+        """
+        Returns True if the shard in the specified path has an index file, in
+        either format.
+        """
+        return (os.path.exists(os.path.join(path, "dexter.bindex")) or
+            os.path.exists(os.path.join(path, "dexter.index")))
+
+    def open_shard(self, path):
+        """
+        Opens the index file of the shard in the specified path, returning a
+        BinaryIndex or a TextIndex depending on which exists. The shard is
+        assumed to have an index (see shard_exists).
+        """
+        filespec = os.path.join(path, "dexter.bindex")
+        if os.path.exists(filespec):
+            return BinaryIndex(filespec)
+        return TextIndex(os.path.join(path, "dexter.index"))
+
+    def map(self, function):
+        """
+        Calls the supplied function with the index of each shard, returning
+        the list of the results, in shard order.
+        """
+        if self.pool:
+            return self.pool.map(function, self.shards)
+        return [function(shard) for shard in self.shards]
+
+    def find(self, word):
+        """
+        Returns the list of (filespec, line_number) locations for the supplied
+        word. Raises a KeyError if the word is not in any of the shards.
+        """
+        def find(shard):
+            try:
+                return shard.find(word)
+            except KeyError:
+                return []
+        locations = [location for result in self.map(find) for location in result]
+        if not locations:
+            raise KeyError(word)
+        return locations
+
+    def count(self, word):
+        """
+        Returns the number of locations of the supplied word. Raises a
+        KeyError if the word is not in any of the shards.
+        """
+        def count(shard):
+            try:
+                return shard.count(word)
+            except KeyError:
+                return 0
+        total = sum(self.map(count))
+        if not total:
+            raise KeyError(word)
+        return total
+
+    def match(self, pattern):
+        """
+        Yields a (word, locations) tuple for each word which matches the
+        supplied pattern, in word order.
+        """
+        results = self.map(lambda shard: list(shard.match(pattern)))
+        groups = [[(word, source, locations) for word, locations in result] for source, result in enumerate(results)]
+        return merge_groups(heapq.merge(*groups))
+
+    def statistics(self):
+        """
+        Yields a (word, locations, files) tuple for each word, in word order,
+        giving the number of locations of the word and the number of files
+        they are in.
+        """
+        current = None
+        for word, locations, files in heapq.merge(*[shard.statistics() for shard in self.shards]):
+            if word != current:
+                if current is not None:
+                    yield (current, total_locations, total_files)
+                (current, total_locations, total_files) = (word, 0, 0)
+            total_locations += locations
+            total_files += files
+        if current is not None:
+            yield (current, total_locations, total_files)
+
+    def words(self):
+        """
+        Yields each word in the index, in word order.
+        """
+        current = None
+        for word in heapq.merge(*[shard.words() for shard in self.shards]):
+            if word != current:
+                current = word
+                yield word
+
+    def load(self):
+        """
+        Reads the whole of the indexes of all the shards, returning them as
+        a single Postings instance.
+        """
+        postings = Postings(self.positions)
+        for shard in self.shards:
+            if not shard.empty:
+                postings.merge(shard.load())
+        return postings
+
+
+class BinaryIndex():
+
+    """
+    Reader and writer for the binary index format (dexter.bindex).
+
+    The file starts with a fixed-size header, followed by the postings of
+    each word, the word and filename strings, and two tables of fixed-size
+    entries: the term directory, sorted by word, and the file table. The
+    reader memory-maps the file and binary-searches the term directory, so
+    that looking up a word only decodes the postings for that word.
+
+    All numbers are stored little-endian:
+
+      header     magic, version, flags, term count, file count,
+                 term directory offset, file table offset, suffix table offset
+      term entry word offset, word length, postings offset, postings count,
+                 file count
+      file entry filename offset, filename length
+      suffix     term number
+      posting    file number, line number (and position, with FLAG_POSITIONS)
+
+    The suffix table lists the term numbers in the order of the reversed
+    words, so that words with a given ending can be found by binary search.
+    If FLAG_POSITIONS is set in the flags, each posting also holds the
+    position of the word within its line.
+
+    If FLAG_COMPRESSED is set in the flags, the postings of each word are
+    sorted and stored as variable-length numbers of seven bits to the byte
+    (see encode_postings), and the postings count is still the number of
+    postings rather than of bytes. The postings of each word end where
+    those of the next word start, and the last ones end where the words
+    start.
+    """
+
+    MAGIC = "DEXI"
+    VERSION = 3
+    HEADER = struct.Struct("<4sHHIIQQQ")
+    TERM_ENTRY = struct.Struct("<QIQII")
+    FILE_ENTRY = struct.Struct("<QI")
+    FLAG_POSITIONS = 1
+    FLAG_COMPRESSED = 2
+
+    def __init__(self, filespec):
+        self.filespec = filespec
+        self.file = open(filespec, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.flags, self.term_count, self.file_count,
+            self.terms_offset, self.files_offset, self.suffixes_offset) = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise IOError("%s is not a Dexter binary index" % filespec)
+        self.positions = bool(self.flags & self.FLAG_POSITIONS)
+        self.compressed = bool(self.flags & self.FLAG_COMPRESSED)
+        self.stride = 3 if self.positions else 2
+        self.empty = self.term_count == 0
+        self.filenames = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Releases the memory-map and the underlying file.
+        """
+        self.map.close()
+        self.file.close()
+
+    def find(self, word):
+        """
+        Returns the list of (filespec, line_number) locations for the supplied
+        word. Raises a KeyError if the word is not in the index.
+        """
+        return self.locations(self.word_number(word))
+
+    def count(self, word):
+        """
+        Returns the number of locations of the supplied word, without
+        decoding them. Raises a KeyError if the word is not in the index.
+        """
+        (offset, length, postings_offset, count, file_count) = self.TERM_ENTRY.unpack_from(
+            self.map, self.terms_offset + self.word_number(word) * self.TERM_ENTRY.size)
+        return count
+
+    def word_number(self, word):
+        """
+        Returns the number of the entry in the term directory for the supplied
+        word. Raises a KeyError if the word is not in the index.
+        """
+        number = self.term_number(word)
+        if number == self.term_count or self.term(number) != word:
+            raise KeyError(word)
+        return number
+
+    def match(self, pattern):
+        """
+        Yields a (word, locations) tuple for each word which matches the
+        supplied pattern, in word order.
+
+        If the pattern starts with some letters, only the part of the term
+        directory for words starting with them is read. Otherwise, if it ends
+        with some letters, the part of the suffix table for words ending with
+        them is read. Failing both, all the words have to be checked, but the
+        postings are still only decoded for the words which match.
+        """
+        (prefix, suffix, regex) = pattern_parts(pattern)
+        if not prefix and suffix:
+            numbers = []
+            reversed_suffix = suffix[::-1]
+            position = self.suffix_position(reversed_suffix)
+            while position < self.term_count:
+                number = self.suffix_term_number(position)
+                word = self.term(number)
+                if not word[::-1].startswith(reversed_suffix):
+                    break
+                if regex.match(word):
+                    numbers.append(number)
+                position += 1
+            # Term numbers are in word order
+            for number in sorted(numbers):
+                yield (self.term(number), self.locations(number))
+            return
+
+        number = self.term_number(prefix)
+        while number < self.term_count:
+            word = self.term(number)
+            if not word.startswith(prefix):
+                break
+            if regex.match(word):
+                yield (word, self.locations(number))
+            number += 1
+
+    def words(self):
+        """
+        Yields each word in the index, in word order.
+        """
+        for number in xrange(self.term_count):
+            yield self.term(number)
+
+    def statistics(self):
+        """
+        Yields a (word, locations, files) tuple for each word in the index,
+        giving the number of locations of the word and the number of files
+        they are in. These are read from the term directory, without decoding
+        any postings.
+        """
+        for number in xrange(self.term_count):
+            (offset, length, postings_offset, count, file_count) = self.TERM_ENTRY.unpack_from(
+                self.map, self.terms_offset + number * self.TERM_ENTRY.size)
+            yield (self.map[offset:offset + length], count, file_count)
+
+    def term_number(self, word):
+        """
+        Returns the number of the first entry in the term directory for the
+        supplied word or a later one.
+        """
+        low = 0
+        high = self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.term(middle) < word:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def suffix_position(self, reversed_word):
+        """
+        Returns the position in the suffix table of the first term which,
+        reversed, is the supplied reversed word or comes after it.
+        """
+        low = 0
+        high = self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.term(self.suffix_term_number(middle))[::-1] < reversed_word:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def suffix_term_number(self, position):
+        """
+        Returns the term number at the supplied position in the suffix table.
+        """
+        return struct.unpack_from("<I", self.map, self.suffixes_offset + position * 4)[0]
+
+    def load(self):
+        """
+        Reads the whole of the index, returning it as a Postings instance.
+        """
+        postings = Postings(self.positions)
+        for number in xrange(self.file_count):
+            postings.file_number(self.filename(number))
+        for number in xrange(self.term_count):
+            postings.words[self.term(number)] = self.entries(number)
+        return postings
+
+    def term(self, number):
+        """
+        Returns the word for the specified entry in the term directory.
+        """
+        (offset, length, postings_offset, count, file_count) = self.TERM_ENTRY.unpack_from(
+            self.map, self.terms_offset + number * self.TERM_ENTRY.size)
+        return self.map[offset:offset + length]
+
+    def locations(self, number):
+        """
+        Decodes the postings for the specified entry in the term directory,
+        returning a list of (filespec, line_number) tuples, or (filespec,
+        line_number, position) tuples if the index has positions.
+        """
+        entries = self.entries(number)
+        if self.positions:
+            return [(self.filename(entries[i]), entries[i + 1], entries[i + 2])
+                for i in xrange(0, len(entries), 3)]
+        return [(self.filename(entries[i]), entries[i + 1]) for i in xrange(0, len(entries), 2)]
+
+    def entries(self, number):
+        """
+        Returns the postings for the specified entry in the term directory as
+        an array of pairs of file and line numbers (or of triples of file and
+        line numbers and positions, if the index has positions).
+        """
+        (offset, length, postings_offset, count, file_count) = self.TERM_ENTRY.unpack_from(
+            self.map, self.terms_offset + number * self.TERM_ENTRY.size)
+        if self.compressed:
+            if number + 1 < self.term_count:
+                end = self.TERM_ENTRY.unpack_from(self.map, self.terms_offset + (number + 1) * self.TERM_ENTRY.size)[2]
+            else:
+                end = self.TERM_ENTRY.unpack_from(self.map, self.terms_offset)[0]
+            return decode_postings(self.map[postings_offset:end], self.stride)
+        entries = array.array("I", self.map[postings_offset:postings_offset + count * self.stride * 4])
+        if sys.byteorder == "big":
+            entries.byteswap()
+        return entries
+
+    def filename(self, number):
+        """
+        Returns the filename for the specified entry in the file table,
+        caching it for subsequent postings.
+        """
+        if number not in self.filenames:
+            (offset, length) = self.FILE_ENTRY.unpack_from(
+                self.map, self.files_offset + number * self.FILE_ENTRY.size)
+            self.filenames[number] = self.map[offset:offset + length]
+        return self.filenames[number]
+
+    def groups(self, source, stale=()):
+        """
+        Yields a (word, source, locations) tuple for each word in the index,
+        in word order, skipping any locations in the stale files. This is the
+        same sequence as read_text_groups() yields for a text index.
+        """
+        for number in xrange(self.term_count):
+            locations = [location for location in self.locations(number) if location[0] not in stale]
+            if locations:
+                yield (self.term(number), source, locations)
+
+    @classmethod
+    def write(cls, filespec, postings, compress=False):
+        """
+        Writes the supplied dictionary of words and their locations (a
+        Postings instance) to the specified file in the binary format,
+        compressing the postings if compress is True.
+        """
+        # Only the files which still have locations are written, in filename
+        # order, so the files must be renumbered
+        stride = postings.stride
+        used = set()
+        for entries in postings.words.itervalues():
+            used.update(entries[0::stride])
+        filenames = sorted(postings.files[number] for number in used)
+        file_numbers = dict((filename, number) for number, filename in enumerate(filenames))
+        renumber = [file_numbers.get(filename, 0) for filename in postings.files]
+
+        def renumbered():
+            for word in sorted(postings):
+                entries = array.array("I", postings.words[word])
+                for i in xrange(0, len(entries), stride):
+                    entries[i] = renumber[entries[i]]
+                yield (word, entries)
+
+        cls.write_entries(filespec, renumbered(), filenames, postings.positions, compress)
+
+    @classmethod
+    def write_groups(cls, filespec, groups, positions=False, compress=False):
+        """
+        Writes the supplied sequence of (word, locations) tuples, which must
+        be in word order, to the specified file in the binary format. The
+        files are numbered in the order in which they are first found. If
+        positions is True, the locations must all have positions. If compress
+        is True, the postings are compressed.
+        """
+        filenames = []
+        file_numbers = {}
+
+        def numbered():
+            for word, locations in groups:
+                entries = array.array("I")
+                for location in locations:
+                    filename = location[0]
+                    number = file_numbers.get(filename)
+                    if number is None:
+                        number = file_numbers[filename] = len(filenames)
+                        filenames.append(filename)
+                    entries.append(number)
+                    entries.extend(location[1:])
+                yield (word, entries)
+
+        cls.write_entries(filespec, numbered(), filenames, positions, compress)
+
+    @classmethod
+    def write_entries(cls, filespec, entries, filenames, positions=False, compress=False):
+        """
+        Writes the supplied sequence of (word, entries) tuples, in word order,
+        to the specified file in the binary format, where entries is an array
+        of pairs of file and line numbers (or triples of file and line numbers
+        and positions, if positions is True), followed by the file table for
+        the supplied list of filenames. The list of filenames is only read
+        once all the entries have been written, so it can be filled in while
+        the entries are being generated. If compress is True, the entries
+        are compressed.
+        """
+        stride = 3 if positions else 2
+        with open(filespec, "wb") as f:
+            # Leave room for the header, which is written last, once all the
+            # offsets are known
+            f.write("\0" * cls.HEADER.size)
+
+            words = []
+            postings_offsets = []
+            for word, values in entries:
+                words.append(word)
+                postings_offsets.append((f.tell(), len(values) // stride, len(set(values[0::stride]))))
+                if compress:
+                    f.write(encode_postings(values, stride))
+                    continue
+                if sys.byteorder == "big":
+                    values.byteswap()
+                f.write(values.tostring())
+
+            term_entries = []
+            for word, (postings_offset, count, file_count) in zip(words, postings_offsets):
+                term_entries.append(cls.TERM_ENTRY.pack(f.tell(), len(word), postings_offset, count, file_count))
+                f.write(word)
+
+            file_entries = []
+            for filename in filenames:
+                file_entries.append(cls.FILE_ENTRY.pack(f.tell(), len(filename)))
+                f.write(filename)
+
+            terms_offset = f.tell()
+            f.write("".join(term_entries))
+            files_offset = f.tell()
+            f.write("".join(file_entries))
+
+            suffixes = array.array("I", sorted(xrange(len(words)), key=lambda number: words[number][::-1]))
+            if sys.byteorder == "big":
+                suffixes.byteswap()
+            suffixes_offset = f.tell()
+            f.write(suffixes.tostring())
+
+            f.seek(0)
+            flags = (cls.FLAG_POSITIONS if positions else 0) | (cls.FLAG_COMPRESSED if compress else 0)
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, flags, len(words), len(filenames),
+                terms_offset, files_offset, suffixes_offset))
+
+def main():
+    """
+    Runs the command given on the command line. The dexter.sh and dexter.bat
+    scripts import this module and call main(), rather than running it as a
+    script, because Python only keeps the compiled form of a module which is
+    imported, and compiling this file takes longer than the rest of the
+    start-up of a 'find'.
+    """
+    params = docopt(__doc__, version='Dexter, v0.0.9')
+
+    #print params
+    
+    api = Dexter()
+    api.execute(params)
+
+if (__name__ == "__main__"):
+    main()
 
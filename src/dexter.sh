@@ -1,3 +1,4 @@
 #!/bin/bash
-# Simple bash file for calling the dexter.py script
-python dexter.py $1 $2 $3 $4 $5 $6 $7 $8 $9
+# Simple bash file for calling the dexter.py script (importing it, so that
+# Python can reuse its compiled form, which starts up faster)
+python -c "import dexter; dexter.main()" $1 $2 $3 $4 $5 $6 $7 $8 $9